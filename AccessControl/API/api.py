@@ -1,9 +1,14 @@
+import sys
+# the gevent server needs the standard library cooperative before anything imports it
+if __name__ == '__main__' and '--debug' not in sys.argv:
+    from gevent import monkey
+    monkey.patch_all()
+
 import asyncio
 import base64
 import csv
 import io
 import re
-import sys
 from decouple import config
 from datetime import datetime, timedelta
 from http import HTTPStatus
@@ -19,7 +24,7 @@ import AccessControl.Data.classes as classes
 import AccessControl.Data.crud as crud
 import AccessControl.Data.generators as gn
 import AccessControl.Data.data_manipulation as dm
-import AccessControl.Functions.matrix_functions as mx
+from AccessControl.Functions.matrix_pool import get_client_manager, MatrixSendError
 import AccessControl.Data.enums as enums
 
 
@@ -33,6 +38,12 @@ app.config['JWT_ACCESS_TOKEN_EXPIRES'] = ACCESS_EXPIRES
 CORS(app)
 
 
+@app.teardown_appcontext
+def _remove_session(exception=None):
+    # every request gets its own session, no state is kept between them
+    crud.remove_session()
+
+
 def _get_person_picture(person):
     picture = crud.first_picture_person(person)
     return dm.img_bytes_to_base64(picture.picture_bytes)
@@ -43,13 +54,8 @@ def _get_person_vaccines(person):
 def _get_employee_comments(employee):
     return [flatten(comment.to_dict()) for comment in crud.comments_by_employee(employee)]
 
-def _set_appointment_status(appointment, status):
-    appointment.status = status
-    if status in {enums.AppointmentStatus.FINALIZED, enums.AppointmentStatus.REJECTED}:
-        appointment.end = datetime.now()
-    elif status == enums.AppointmentStatus.ONGOING:
-        appointment.start = datetime.now()
-    crud.commit()
+# lives in crud, so the recognizer can use it without loading the app
+_set_appointment_status = crud.set_appointment_status
 
 @app.route('/persons', methods=['GET']) #
 @jwt_required()
@@ -438,22 +444,15 @@ def login():
 
 @app.route('/open-door', methods=['GET'])
 @jwt_required()
-async def openDoor():
+def openDoor():
     time_out = 10
-    server = config('MATRIX_SERVER')
-    user = config('MATRIX_USER')
-    password = config('MATRIX_PASSWORD')
-    device_id = config('MATRIX_DEVICE_ID_FACERECOG')
     door_room_name = config('MATRIX_ROOM_NAME_DOOR')
     try:
-        client = await asyncio.wait_for(mx.matrix_login(server, user, password, device_id), time_out)
-        door_room_id = await asyncio.wait_for(mx.matrix_get_room_id(client, door_room_name), time_out)
-        message = '1'
-        await asyncio.wait_for(mx.matrix_send_message(client, door_room_id, message), time_out)
+        # the client of the worker is already logged in, it is a single send
+        get_client_manager().send(door_room_name, '1', time_out)
         msg = 'Door oppened correctly'
         code = HTTPStatus.OK
-        await asyncio.wait_for(mx.matrix_logout_close(client), time_out)
-    except asyncio.TimeoutError:
+    except MatrixSendError:
         msg = 'Error opening door'
         code = HTTPStatus.SERVICE_UNAVAILABLE
 
@@ -519,11 +518,7 @@ def add_comment():
 
 @app.route('/set-config', methods=['PATCH'])
 # @jwt_required()
-async def set_config():
-    server = config('MATRIX_SERVER')
-    user = config('MATRIX_USER')
-    password = config('MATRIX_PASSWORD')
-    device_id = config('MATRIX_DEVICE_ID_BACKEND')
+def set_config():
     lang_room_name = config('MATRIX_ROOM_NAME_LANGUAGE')
 
     data = request.get_json(force=True)
@@ -546,16 +541,10 @@ async def set_config():
         time_out = 20
         language = enums.SpeakerLanguages(int(data['language'])).name
         try:
-            client = await asyncio.wait_for(
-                mx.matrix_login(server, user, password, device_id), time_out)
-            lang_room_id = await asyncio.wait_for(
-                mx.matrix_get_room_id(client, lang_room_name), time_out)
-            await asyncio.wait_for(
-                mx.matrix_send_message(client, lang_room_id, language), time_out)
-            await asyncio.wait_for(mx.matrix_logout_close(client), time_out)
+            get_client_manager().send(lang_room_name, language, time_out)
             msg = 'Configuration Set Succesfully'
             code = HTTPStatus.OK
-        except asyncio.TimeoutError:
+        except MatrixSendError:
             msg = 'Error Setting Configuration'
             code = HTTPStatus.SERVICE_UNAVAILABLE
 
@@ -575,5 +564,6 @@ if __name__ == '__main__':
         app.run(host='0.0.0.0', debug=True)
     else:
         from gevent.pywsgi import WSGIServer
+        crud.set_session_scope('greenlet')
         http_server = WSGIServer(('', 5000), app)
         http_server.serve_forever()
@@ -7,17 +7,27 @@ from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy_serializer import SerializerMixin
 import AccessControl.Data.enums as enums
 
-# setting up parameters
-_user = config('DB_USER')
-_password = config('DB_PASSWORD')
-_host = '127.0.0.1'
-_port = '5432'  # database port
-_database = config('DB_NAME')
-
+# setting up parameters, DB_URL takes any database (e.g. the sqlite one of the replay)
+_url = config('DB_URL', default='')
+if not _url:
+    _user = config('DB_USER')
+    _password = config('DB_PASSWORD')
+    _host = '127.0.0.1'
+    _port = '5432'  # database port
+    _database = config('DB_NAME')
+    _url = f'postgresql+psycopg2://{_user}:{_password}@{_host}:{_port}/{_database}'
+
+
+# connection pool of each process, pre ping replaces the connections the server dropped
+_pool = {'pool_pre_ping': config('DB_POOL_PRE_PING', default=True, cast=bool)}
+if not _url.startswith('sqlite'):
+    _pool.update(pool_size=config('DB_POOL_SIZE', default=5, cast=int),
+                 max_overflow=config('DB_MAX_OVERFLOW', default=10, cast=int),
+                 pool_recycle=config('DB_POOL_RECYCLE', default=1800, cast=int),
+                 pool_timeout=config('DB_POOL_TIMEOUT', default=30, cast=int))
 
 # getting engine
-engine = sqlalchemy.create_engine(
-    f'postgresql+psycopg2://{_user}:{_password}@{_host}:{_port}/{_database}')
+engine = sqlalchemy.create_engine(_url, **_pool)
 
 # getting base for classes
 Base = declarative_base()
@@ -86,13 +96,16 @@ class Employee(Base, SerializerMixin):
 class Picture(Base, SerializerMixin):
     __tablename__ = 'pictures'
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-    picture_bytes = sqlalchemy.Column(sqlalchemy.dialects.postgresql.BYTEA)
-    face_bytes = sqlalchemy.Column(sqlalchemy.dialects.postgresql.BYTEA)
+    # LargeBinary is BYTEA on postgres
+    picture_bytes = sqlalchemy.Column(sqlalchemy.LargeBinary)
+    face_bytes = sqlalchemy.Column(sqlalchemy.LargeBinary)
 
     person_id = sqlalchemy.Column(
         sqlalchemy.Integer, sqlalchemy.ForeignKey('persons.id'))
+    # set when an existing picture changes, the encoding cache watches it
+    updated_at = sqlalchemy.Column(sqlalchemy.DateTime, onupdate=datetime.now)
 
-    serialize_rules = ('-person','-time_entry','-person_id')
+    serialize_rules = ('-person','-time_entry','-person_id','-updated_at')
 
     person = sqlalchemy.orm.relationship("Person", back_populates="pictures")
     time_entry = sqlalchemy.orm.relationship(
@@ -201,6 +214,14 @@ class Camera(Base, SerializerMixin):
     entry_type = sqlalchemy.Column(sqlalchemy.Enum(enums.EntryTypes))
     ask_mask = sqlalchemy.Column(sqlalchemy.Boolean, default=True)
     ask_temp = sqlalchemy.Column(sqlalchemy.Boolean, default=True)
+    # fraction of the frame size the face detector runs at, None for a fixed 300x300 input
+    detection_scale = sqlalchemy.Column(sqlalchemy.Float, nullable=True)
+    # fraction of changed pixels needed to run the detector, None for MOTION_THRESHOLD, 0 to never skip frames
+    motion_threshold = sqlalchemy.Column(sqlalchemy.Float, nullable=True)
+    # region watched for motion, 'x,y,width,height' as fractions of the frame
+    motion_roi = sqlalchemy.Column(sqlalchemy.String(35), nullable=True)
+    # JSON stage intervals over the STAGE_POLICY ones, see Functions/scheduler.py
+    stage_policy = sqlalchemy.Column(sqlalchemy.String(255), nullable=True)
 
     def connection_string(self):
         return (0 if self.ip_address == '0.0.0.0' else
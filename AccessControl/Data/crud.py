@@ -5,13 +5,51 @@ import sqlalchemy
 import time
 import datetime
 import holidays
+from decouple import config
 
 Session = sqlalchemy.orm.sessionmaker()
 Session.configure(bind=classes.engine)
-_session = Session()
 REGULAR_WORK_HOURS = 8
 
 
+def _scoped_session(scope):
+    '''
+    Returns a session registry with a session for each thread, or for each
+    greenlet when scope is greenlet (a gevent server runs every request on
+    its own greenlet of the same thread).
+    The greenlet scope also makes psycopg2 yield to the gevent hub while it
+    waits on the database. The rest of the standard library has to be
+    patched by gevent before the app is imported: the api does it for its
+    own server, a uwsgi gevent worker needs gevent-monkey-patch
+    '''
+    if scope == 'greenlet':
+        from greenlet import getcurrent
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        return sqlalchemy.orm.scoped_session(Session, scopefunc=getcurrent)
+    return sqlalchemy.orm.scoped_session(Session)
+
+
+_session = _scoped_session(config('DB_SESSION_SCOPE', default='thread'))
+
+
+def set_session_scope(scope):
+    '''
+    Replaces the session registry, before any request is served
+    '''
+    global _session
+    _session.remove()
+    _session = _scoped_session(scope)
+
+
+def remove_session():
+    '''
+    Closes the session of the current thread (or greenlet), giving its
+    connection back to the pool. The next call opens a new one
+    '''
+    _session.remove()
+
+
 def add_entry(entry):
     '''
     Adds an entry to de database
@@ -130,6 +168,18 @@ def first_picture_person(person):
 def appointments_by_person(person):
     return _session.query(classes.Appointment).filter(classes.Appointment.person_id==person.id).all()
 
+def set_appointment_status(appointment, status):
+    '''
+    Sets the status of the appointment, with its start or end time
+    '''
+    appointment.status = status
+    if status in {enums.AppointmentStatus.FINALIZED, enums.AppointmentStatus.REJECTED}:
+        appointment.end = datetime.datetime.now()
+    elif status == enums.AppointmentStatus.ONGOING:
+        appointment.start = datetime.datetime.now()
+    _session.commit()
+
+
 def appointment_by_person_time(person, entry_type):
     return _session.query(classes.Appointment).filter(classes.Appointment.person_id==person.id).filter(classes.Appointment.status==enums.AppointmentStatus.ACCEPTED).filter((classes.Appointment.start + datetime.timedelta(hours=1)) >= datetime.datetime.now()).first() if entry_type == enums.EntryTypes.ENTRY else _session.query(classes.Appointment).filter(classes.Appointment.person_id==person.id).filter(classes.Appointment.status==enums.AppointmentStatus.ONGOING).first()
 
@@ -145,6 +195,38 @@ def get_employees_pictures():
 def get_accepted_appointments_pictures():
     return (_session.query(classes.Picture).join(classes.Person).join(classes.Appointment).filter((classes.Appointment.status == enums.AppointmentStatus.ACCEPTED) | (classes.Appointment.status == enums.AppointmentStatus.ONGOING)).all())
 
+def get_all_pictures_ids():
+    return [pic_id for pic_id, in _session.query(classes.Picture.id).join(classes.Picture.person).
+            filter(classes.Person.active)]
+
+def get_employees_pictures_ids():
+    return [pic_id for pic_id, in _session.query(classes.Picture.id).join(classes.Picture.person).
+            filter(classes.Person.role >= enums.PersonRole.PERSON).filter(classes.Person.active)]
+
+def get_accepted_appointments_pictures_ids():
+    return [pic_id for pic_id, in _session.query(classes.Picture.id).join(classes.Person).join(classes.Appointment).filter((classes.Appointment.status == enums.AppointmentStatus.ACCEPTED) | (classes.Appointment.status == enums.AppointmentStatus.ONGOING)).distinct()]
+
+def get_pictures_watermark():
+    '''
+    Returns tuple (count, max id, last update) of the pictures table
+    '''
+    return _session.query(sqlalchemy.func.count(classes.Picture.id), sqlalchemy.func.max(classes.Picture.id),
+                          sqlalchemy.func.max(classes.Picture.updated_at)).one()
+
+def get_pictures_faces_after(pic_id):
+    '''
+    Returns tuples (id, person_id, face_bytes) of the pictures with an id greater than the given one,
+    ordered by id and without loading the raw picture
+    '''
+    return (_session.query(classes.Picture.id, classes.Picture.person_id, classes.Picture.face_bytes).
+            filter(classes.Picture.id > pic_id).order_by(classes.Picture.id).all())
+
+def expire_all():
+    '''
+    Forces the next access to every loaded entry to read it again from the database
+    '''
+    _session.expire_all()
+
 def get_closest_entry_employee(employee_id):
     return _session.query(classes.Time_Entry).filter(classes.Time_Entry.person_id == employee_id, classes.Time_Entry.action_time < datetime.datetime.now()).order_by(classes.Time_Entry.action_time.desc()).first()
 
@@ -1,10 +1,10 @@
 import os
 import sys
-import face_recognition as fr
 import numpy as np
 import AccessControl.Data.crud as crud
 import AccessControl.Data.enums as enums
 import AccessControl.Data.classes as classes
+import AccessControl.Data.encoding_cache as encoding_cache
 
 from PIL import Image
 from numpy_serializer import to_bytes, from_bytes
@@ -26,6 +26,8 @@ def process_picture_path(path: str, large: bool = False):
     except Exception as error:
         print(error)
         return None
+    import face_recognition as fr  # loads the dlib models, only when used
+
     pic = fr.load_image_file(path)
     face_encodings = fr.face_encodings(pic, model=mod)
     if face_encodings:
@@ -42,6 +44,8 @@ def process_picture_file(img_data, large: bool = False):
     '''
     data = None
     mod = 'large' if large else 'small'
+    import face_recognition as fr  # loads the dlib models, only when used
+
     image = Image.open(img_data)
     pic = np.array(image)
     face_encodings = fr.face_encodings(pic, model=mod)
@@ -120,7 +124,8 @@ def insert_picture_file(path: str):
 def insert_picture_discovered(person_id, picture_frame, face_encoding, action):
     '''
     Inserts single picture into database. Used for frames taken live.
-    Both the the picture_frame and the face_encoding must be arrays
+    Both the the picture_frame and the face_encoding must be arrays.
+    Returns the inserted picture
     '''
     picture_bytes = to_bytes(picture_frame)
     face_bytes = to_bytes(face_encoding)
@@ -133,6 +138,7 @@ def insert_picture_discovered(person_id, picture_frame, face_encoding, action):
 
     crud.add_entry(newPicture)
     crud.add_entry(newTimeEntry)
+    return newPicture
 
 def fix_entry(person_id, entry_type):
     time_last_entry = crud.get_closest_entry_employee(person_id).action_time
@@ -164,26 +170,42 @@ def get_pictures_encodings():
     return pic_list
 
 
+def get_pictures_arrays_by_type(profile):
+    '''
+    Returns tuple of arrays (person_ids, face_encodings, pic_ids) of the pictures
+    of the profile, read from the local encoding cache
+    '''
+    return encoding_cache.get_cache().lookup(get_pictures_ids_by_type(profile))
+
+
 def get_pictures_encodings_by_type(profile):
     '''
     Returns list of tuples in the format (person_id, face_encoding, pic_id)
     '''
-    pics = None
+    return list(zip(*get_pictures_arrays_by_type(profile)))
+
+
+def get_pictures_ids_by_type(profile):
+    '''
+    Returns list of the ids of the pictures that belong to the profile
+    '''
+    pic_ids = []
     if profile == enums.PictureClassification.ALL_ACTIVE:
-        pics = crud.get_all_pictures()
+        pic_ids = crud.get_all_pictures_ids()
     elif profile == enums.PictureClassification.EMPLOYEES_ACTIVE:
-        pics = crud.get_employees_pictures()
+        pic_ids = crud.get_employees_pictures_ids()
     elif profile == enums.PictureClassification.ACCEPTED_APPOINTMENTS:
-        pics = crud.get_accepted_appointments_pictures()
+        pic_ids = crud.get_accepted_appointments_pictures_ids()
 
-    pic_list = []
-    for pic in pics:
-        person_id = pic.person_id
-        pic_id = pic.id
-        face_encodings = unprocess_picture(pic.face_bytes)
-        pic_list.append((person_id, face_encodings, pic_id))
+    return pic_ids
 
-    return pic_list
+
+def get_pictures_arrays_by_ids(ids):
+    '''
+    Returns tuple of arrays (person_ids, face_encodings, pic_ids) of the given pictures,
+    read from the local encoding cache
+    '''
+    return encoding_cache.get_cache().lookup(ids)
 
 
 def get_pictures():
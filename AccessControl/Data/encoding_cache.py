@@ -0,0 +1,177 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import numpy as np
+import AccessControl.Data.crud as crud
+
+from decouple import config
+from numpy_serializer import from_bytes
+
+
+VERSION = 2
+ENCODING_SIZE = 128
+# pictures added since the cache file was written are kept in memory until
+# there are enough of them to be worth rewriting the file
+FLUSH_MIN_SIZE = 1024
+FLUSH_RATIO = 0.1
+# builds no longer published are removed once they are this old (seconds),
+# newer ones may still be being written by another process
+STALE_BUILD = 3600
+
+
+class EncodingCache:
+    '''
+    Local copy of the face encodings of every picture on the database.
+    The encodings are stored as a .npy matrix that is memory-mapped when
+    loaded, next to an .npy of (pic_id, person_id) rows sorted by pic_id.
+    Every build of the pair goes to a directory of its own, and a versioned
+    json file names the published one, with the watermark (count, max id,
+    last update) of the pictures table it was written for. Replacing the
+    json publishes a build at once, processes writing at the same time
+    never mix their files.
+    Pictures added later are kept in memory arrays of their own, searched
+    along with the file, until there are enough of them to rewrite it.
+    An update of an existing picture (its encoding or person) is seen
+    through its updated_at column and builds the whole cache again; it is
+    set by updates made through SQLAlchemy, not by raw SQL.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._name = f'encodings.v{VERSION}'
+        self._meta_path = os.path.join(directory, f'{self._name}.json')
+        self._base_ids = np.empty((0, 2), dtype=np.int64)
+        self._base_encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._extra_ids = np.empty((0, 2), dtype=np.int64)
+        self._extra_encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self.watermark = (0, 0, None)
+        self._load()
+
+    def __len__(self):
+        return len(self._base_ids) + len(self._extra_ids)
+
+    def _clear(self):
+        self._base_ids = np.empty((0, 2), dtype=np.int64)
+        self._base_encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._extra_ids = np.empty((0, 2), dtype=np.int64)
+        self._extra_encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+
+    def _load(self):
+        try:
+            with open(self._meta_path) as file:
+                meta = json.load(file)
+            if meta['version'] != VERSION:
+                return
+            build = os.path.join(self.directory, meta['build'])
+            ids = np.load(os.path.join(build, 'ids.npy'))
+            encodings = np.load(os.path.join(build, 'encodings.npy'), mmap_mode='r')
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        if len(ids) != len(encodings) or len(ids) != meta['watermark'][0]:
+            return
+        self._base_ids = ids
+        self._base_encodings = encodings
+        self.watermark = tuple(meta['watermark'])
+
+    def _save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        # the build is written on a new directory and published by moving
+        # the json over, so a crash never leaves a half written cache behind.
+        # This is the only time the mapped encodings are read whole
+        ids = np.concatenate((self._base_ids, self._extra_ids))
+        encodings = np.concatenate((self._base_encodings, self._extra_encodings))
+        build = tempfile.mkdtemp(prefix=f'{self._name}.', dir=self.directory)
+        np.save(os.path.join(build, 'encodings.npy'), np.ascontiguousarray(encodings))
+        np.save(os.path.join(build, 'ids.npy'), np.ascontiguousarray(ids))
+        descriptor, meta_path = tempfile.mkstemp(prefix=f'{self._name}.', suffix='.tmp', dir=self.directory)
+        with os.fdopen(descriptor, 'w') as file:
+            json.dump({'version': VERSION, 'build': os.path.basename(build),
+                       'watermark': list(self.watermark)}, file)
+        os.replace(meta_path, self._meta_path)
+        self._remove_stale(os.path.basename(build))
+        self._base_ids = ids
+        self._base_encodings = np.load(os.path.join(build, 'encodings.npy'), mmap_mode='r')
+        self._extra_ids = np.empty((0, 2), dtype=np.int64)
+        self._extra_encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+
+    def _remove_stale(self, published):
+        # files already mapped by other processes stay readable after removal
+        limit = time.time() - STALE_BUILD
+        for entry in os.scandir(self.directory):
+            if (entry.name.startswith(f'{self._name}.') and entry.name != published
+                    and not entry.name.endswith('.json') and entry.stat().st_mtime < limit):
+                if entry.is_dir():
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+
+    def _append(self, rows):
+        # rows come ordered by id and after every cached one, so the extra
+        # arrays stay sorted; only they are copied, never the mapped file
+        ids = np.array([(pic_id, person_id) for pic_id, person_id, _ in rows], dtype=np.int64).reshape(-1, 2)
+        encodings = np.array([from_bytes(face_bytes) for _, _, face_bytes in rows],
+                             dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        self._extra_ids = np.concatenate((self._extra_ids, ids))
+        self._extra_encodings = np.concatenate((self._extra_encodings, encodings))
+
+    def sync(self):
+        '''
+        Validates the cache against the watermark of the pictures table.
+        If pictures were only added, just those are fetched, if any was
+        deleted or updated the whole cache is built again
+        '''
+        count, max_id, updated_at = crud.get_pictures_watermark()
+        watermark = (count, max_id or 0, updated_at.isoformat() if updated_at else None)
+        if watermark == self.watermark:
+            return self
+
+        rows = []
+        if watermark[1] >= self.watermark[1] and watermark[2] == self.watermark[2]:
+            rows = crud.get_pictures_faces_after(self.watermark[1])
+        rebuild = watermark[2] != self.watermark[2] or len(self) + len(rows) != count
+        if rebuild:
+            self._clear()
+            rows = crud.get_pictures_faces_after(0)
+        self._append(rows)
+        self.watermark = watermark
+
+        if rebuild or len(self._extra_ids) >= max(FLUSH_MIN_SIZE, FLUSH_RATIO * len(self._base_ids)):
+            self._save()
+        return self
+
+    def lookup(self, pic_ids):
+        '''
+        Returns arrays (person_ids, encodings, pic_ids) of the given pictures.
+        Pictures missing from the cache are left out
+        '''
+        pic_ids = np.asarray(sorted(pic_ids), dtype=np.int64)
+        # every extra id is greater than the ids on the file, the results stay sorted
+        found = [_search(ids, encodings, pic_ids) for ids, encodings in
+                 ((self._base_ids, self._base_encodings), (self._extra_ids, self._extra_encodings))]
+        return tuple(np.concatenate(arrays) for arrays in zip(*found))
+
+
+def _search(ids, encodings, pic_ids):
+    # (person_ids, encodings, pic_ids) of the given sorted ids found on ids
+    cached_ids = ids[:, 0]
+    positions = np.searchsorted(cached_ids, pic_ids)
+    inside = positions < len(cached_ids)
+    positions, pic_ids = positions[inside], pic_ids[inside]
+    positions = positions[cached_ids[positions] == pic_ids]
+    return ids[positions, 1], encodings[positions], ids[positions, 0]
+
+
+_cache = None
+
+
+def get_cache():
+    '''
+    Returns the cache of the process, loading it from disk the first time
+    '''
+    global _cache
+    if _cache is None:
+        _cache = EncodingCache(config(
+            'ENCODING_CACHE_DIR', default=os.path.expanduser('~/.cache/AccessControl')))
+    return _cache.sync()
@@ -68,11 +68,18 @@ def camera_init():
             entry_type = enums.EntryTypes(int(row['entry_type']))
             ask_mask = bool(int(row['ask_mask']))
             ask_temp = bool(int(row['ask_temp']))
+            detection_scale = float(row['detection_scale']) if row.get('detection_scale') else None
+            motion_threshold = float(row['motion_threshold']) if row.get('motion_threshold') else None
+            motion_roi = row.get('motion_roi') or None
+            stage_policy = row.get('stage_policy') or None
 
             camera = classes.Camera(
                 ip_address=ip, user=user, password=password,
                 route=route, entry_type=entry_type,
-                ask_mask=ask_mask, ask_temp=ask_temp)
+                ask_mask=ask_mask, ask_temp=ask_temp,
+                detection_scale=detection_scale,
+                motion_threshold=motion_threshold, motion_roi=motion_roi,
+                stage_policy=stage_policy)
             crud.add_entry(camera)
 
 
@@ -0,0 +1,128 @@
+import numpy as np
+
+
+CHUNK_SIZE = 4096  # rows per block when assigning encodings to centroids
+
+
+def _squared_distances(vectors, centroids, centroid_norms):
+    return (np.einsum('ij,ij->i', vectors, vectors)[:, None]
+            - 2 * (vectors @ centroids.T) + centroid_norms[None, :])
+
+
+def _nearest_centroid(vectors, centroids):
+    centroid_norms = np.einsum('ij,ij->i', centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), CHUNK_SIZE):
+        block = vectors[start:start + CHUNK_SIZE]
+        assignments[start:start + CHUNK_SIZE] = np.argmin(
+            _squared_distances(block, centroids, centroid_norms), axis=1)
+    return assignments
+
+
+def kmeans(vectors, k, iterations=10, seed=0):
+    '''
+    Lloyd's k-means. Returns the (k, d) float32 matrix of centroids
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _nearest_centroid(vectors, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # empty clusters are moved to random encodings so no list is wasted
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = vectors[rng.choice(len(vectors), len(empty), replace=False)]
+    return centroids
+
+
+class IVFIndex:
+    '''
+    Inverted file index for the encodings of a Gallery.
+    Encodings are clustered with k-means and a search only scans the
+    nprobe clusters whose centroids are the closest to the query, so more
+    probes give better recall and fewer give faster lookups.
+    Galleries smaller than min_size are scanned exhaustively.
+    The index only keeps the cluster of each gallery row, the gallery
+    keeps the encodings and tells the index about every add or removal.
+    '''
+
+    def __init__(self, nlist=0, nprobe=8, min_size=2000, iterations=10, train_size=64, seed=0):
+        self.nlist = nlist  # 0 means sqrt of the gallery size
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.iterations = iterations
+        self.train_size = train_size  # sampled encodings per cluster when training
+        self.seed = seed
+        self.centroids = None
+        self._assignments = np.empty(0, dtype=np.int32)
+        self._lists = None
+        self._trained_size = 0
+
+    def __str__(self) -> str:
+        nlist = 0 if self.centroids is None else len(self.centroids)
+        return f'IVFIndex... lists: {nlist}, probes: {self.nprobe}, rows: {len(self._assignments)}'
+
+    @property
+    def trained(self):
+        return self.centroids is not None
+
+    def train(self, encodings):
+        '''
+        Clusters the encodings and assigns every one of them to its list
+        '''
+        size = len(encodings)
+        nlist = min(self.nlist or int(np.sqrt(size)), size)
+        rng = np.random.default_rng(self.seed)
+        sample = encodings
+        if size > nlist * self.train_size:
+            sample = encodings[np.sort(rng.choice(size, nlist * self.train_size, replace=False))]
+        self.centroids = kmeans(sample, nlist, self.iterations, self.seed)
+        self._assignments = _nearest_centroid(np.asarray(encodings, dtype=np.float32), self.centroids)
+        self._lists = None
+        self._trained_size = size
+
+    def add(self, encodings):
+        if self.trained:
+            self._assignments = np.concatenate(
+                (self._assignments, _nearest_centroid(encodings, self.centroids)))
+            self._lists = None
+
+    def remove(self, keep):
+        '''
+        keep is the boolean mask of the gallery rows that were kept
+        '''
+        if self.trained:
+            self._assignments = self._assignments[keep]
+            self._lists = None
+
+    def _get_lists(self):
+        if self._lists is None:
+            order = np.argsort(self._assignments, kind='stable')
+            bounds = np.cumsum(np.bincount(self._assignments, minlength=len(self.centroids)))[:-1]
+            self._lists = np.split(order, bounds)
+        return self._lists
+
+    def candidates(self, encoding, encodings):
+        '''
+        Returns the gallery rows to scan for the encoding,
+        or None if the whole gallery has to be scanned
+        '''
+        size = len(encodings)
+        if size < self.min_size:
+            return None
+        # the clusters are trained again once the gallery has doubled
+        if not self.trained or size >= 2 * self._trained_size:
+            self.train(encodings)
+
+        centroid_distances = _squared_distances(
+            encoding[None, :], self.centroids, np.einsum('ij,ij->i', self.centroids, self.centroids))[0]
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes = np.argpartition(centroid_distances, nprobe - 1)[:nprobe]
+        lists = self._get_lists()
+        rows = np.concatenate([lists[probe] for probe in probes])
+        return rows if len(rows) else None
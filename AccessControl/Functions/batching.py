@@ -0,0 +1,97 @@
+import time
+import threading
+import numpy as np
+from concurrent.futures import Future
+
+
+class MaskBatcher:
+    '''
+    Micro-batching front of the mask classifier.
+    Face crops sent from any thread (every camera and frame) are collected
+    for up to window seconds, or until max_batch faces are waiting, then run
+    through the model as one batch and the predictions are handed back to
+    each caller. A bigger window gives bigger batches (throughput) at the
+    cost of latency.
+    It has the predict method of the Keras model, so it can be used in its place
+    '''
+
+    def __init__(self, model, window=0.005, max_batch=32):
+        self.model = model
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.faces = 0
+        self.largest_batch = 0
+        self.wait_time = 0.0  # total seconds requests spent waiting for their batch
+        self._pending = []
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __str__(self) -> str:
+        return (f'MaskBatcher... batches: {self.batches}, faces: {self.faces}, '
+                f'mean batch: {self.mean_batch():.2f}, largest batch: {self.largest_batch}')
+
+    def mean_batch(self):
+        return self.faces / self.batches if self.batches else 0
+
+    def stats(self):
+        return {'batches': self.batches, 'faces': self.faces,
+                'mean_batch': self.mean_batch(), 'largest_batch': self.largest_batch,
+                'mean_wait': self.wait_time / self.faces if self.faces else 0}
+
+    def stop(self):
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._thread.join()
+
+    def submit(self, faces):
+        '''
+        Queues an array of preprocessed faces, returns a Future with their predictions
+        '''
+        future = Future()
+        with self._condition:
+            self._pending.append((np.asarray(faces, dtype='float32'), future, time.time()))
+            self._condition.notify_all()
+        return future
+
+    def predict(self, faces, batch_size=None):
+        return self.submit(faces).result()
+
+    def _waiting(self):
+        return sum(len(faces) for faces, _, _ in self._pending)
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._stop.is_set())
+                if self._stop.is_set():
+                    break
+                # the window starts with the oldest request
+                deadline = self._pending[0][2] + self.window
+                while self._waiting() < self.max_batch and not self._stop.is_set():
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                requests, self._pending = self._pending, []
+
+            batch = np.concatenate([faces for faces, _, _ in requests])
+            try:
+                preds = np.asarray(self.model.predict_on_batch(batch))
+            except Exception as error:
+                for _, future, _ in requests:
+                    future.set_exception(error)
+                continue
+
+            now = time.time()
+            self.batches += 1
+            self.faces += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            start = 0
+            for faces, future, queued in requests:
+                self.wait_time += (now - queued) * len(faces)
+                future.set_result(preds[start:start + len(faces)])
+                start += len(faces)
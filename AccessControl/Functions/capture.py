@@ -0,0 +1,90 @@
+import time
+import threading
+import numpy as np
+from cv2 import cv2
+
+
+RECONNECT_DELAY = 2  # seconds to wait before opening a camera that failed
+
+
+class FrameGrabber:
+    '''
+    Reads frames from a camera on its own thread, so the camera buffer never
+    fills while inference runs. Only the newest frames are kept, on a ring
+    buffer allocated once, older ones are dropped.
+    Counters: frames captured, frames dropped without being read, and lag
+    (age of the frame handed out by the last read) in seconds
+    '''
+
+    def __init__(self, source, size=2):
+        self.source = source
+        self.size = max(size, 2)
+        self.captured = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self._buffer = None
+        self._timestamps = np.zeros(self.size)
+        self._last_read = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __str__(self) -> str:
+        return f'FrameGrabber... captured: {self.captured}, dropped: {self.dropped}, lag: {self.lag:.3f}s'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._condition:
+            self._condition.notify_all()
+        # a camera stuck on a read is left behind, the thread is a daemon
+        self._thread.join(RECONNECT_DELAY)
+
+    def stats(self):
+        return {'captured': self.captured, 'dropped': self.dropped, 'lag': self.lag}
+
+    def _run(self):
+        capture = cv2.VideoCapture(self.source)
+        while not self._stop.is_set():
+            # frames are decoded straight into the slot after the newest one,
+            # which readers never touch, so no lock is held while decoding
+            slot = self.captured % self.size
+            target = None if self._buffer is None else self._buffer[slot]
+            ok = capture.grab()
+            if ok:
+                ok, frame = capture.retrieve(target)
+            if not ok:
+                capture.release()
+                self._stop.wait(RECONNECT_DELAY)
+                capture = cv2.VideoCapture(self.source)
+                continue
+
+            with self._condition:
+                if self._buffer is None or self._buffer.shape[1:] != frame.shape:
+                    self._buffer = np.empty((self.size,) + frame.shape, dtype=frame.dtype)
+                    self._buffer[slot] = frame
+                elif not np.shares_memory(frame, target):
+                    self._buffer[slot] = frame
+                self._timestamps[slot] = time.time()
+                self.captured += 1
+                self._condition.notify_all()
+        capture.release()
+
+    def read(self, timeout=1.0):
+        '''
+        Waits for a frame newer than the last one read and returns (ok, frame)
+        like cv2.VideoCapture.read. The frame is a copy, it can be kept
+        '''
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.captured > self._last_read or self._stop.is_set(), timeout)
+            if self.captured <= self._last_read:
+                return False, None
+            slot = (self.captured - 1) % self.size
+            self.dropped += self.captured - self._last_read - 1
+            self._last_read = self.captured
+            self.lag = time.time() - self._timestamps[slot]
+            return True, self._buffer[slot].copy()
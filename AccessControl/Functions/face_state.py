@@ -0,0 +1,42 @@
+import time
+
+
+class FaceState:
+    '''
+    Decision state of one face in front of the camera.
+    Locations are (startX, startY, endX, endY) boxes on the frame
+    '''
+
+    def __init__(self, location):
+        self.location = location
+        self.last_seen = time.time()
+        self.first_seen = self.last_seen
+        self.person_id = None
+        self.encoding = None
+        self.frame = None  # BGR frame the face was recognized on
+        self.mask = None  # last result of the mask classifier
+        self.mask_detection_flag = False
+        self.face_recognition_flag = False
+        self.temp_comprobation_flag = False
+        self.time_since_mask = time.time()
+        # a new face can be classified, recognized and welcomed right away
+        self.time_mask_detection = 0
+        self.time_face_recognition = 0
+        self.time_welcomed = 0
+
+    def __str__(self) -> str:
+        return (f'FaceState... person id: {self.person_id}, recognized: {self.face_recognition_flag}, '
+                f'mask: {self.mask_detection_flag}, temp: {self.temp_comprobation_flag}')
+
+    def see(self, location):
+        self.location = location
+        self.last_seen = time.time()
+
+    def reset(self):
+        # called once the door was opened (or denied) for this face
+        self.mask_detection_flag = False
+        self.face_recognition_flag = False
+        self.temp_comprobation_flag = False
+        self.time_since_mask = time.time()
+        self.time_face_recognition = time.time()
+        self.time_welcomed = time.time()
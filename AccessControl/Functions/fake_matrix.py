@@ -0,0 +1,193 @@
+import time
+import random
+import asyncio
+import threading
+from types import SimpleNamespace
+from decouple import config
+
+
+POLL_INTERVAL = 0.02  # seconds between checks of a waiting sync
+
+
+class FakeEvent:
+    def __init__(self, event_id, sender, body, msgtype='m.text'):
+        self.event_id = event_id
+        self.sender = sender
+        self.body = body
+        self.server_timestamp = int(time.time() * 1000)
+        self.source = {'type': 'm.room.message', 'event_id': event_id, 'sender': sender,
+                       'content': {'body': body, 'msgtype': msgtype}}
+
+
+class FakeHomeserver:
+    '''
+    In-process store of the fake Matrix rooms. Every fake client of the
+    process talks to the same one, whatever their event loops, so a message
+    sent by one is seen by the syncs of the others. Rooms exist as soon as
+    their alias is resolved. Stream positions are event counts
+    '''
+
+    def __init__(self):
+        self._rooms = {}  # room id -> list of events
+        self._events = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def room_id(alias):
+        return f"!{alias.lstrip('#').split(':')[0]}:fake"
+
+    def resolve(self, alias):
+        room_id = self.room_id(alias)
+        with self._lock:
+            self._rooms.setdefault(room_id, [])
+        return room_id
+
+    def publish(self, room_id, body, sender='@fake:fake'):
+        '''
+        Adds a text message to the room, returns the event
+        '''
+        with self._lock:
+            self._events += 1
+            event = FakeEvent(f'$fake{self._events}', sender, body)
+            self._rooms.setdefault(room_id, []).append((self._events, event))
+        return event
+
+    def position(self):
+        return self._events
+
+    def rooms(self):
+        with self._lock:
+            return list(self._rooms)
+
+    def events(self, room_id, since=0, until=None):
+        '''
+        Returns the events of the room after the stream position since, up to until
+        '''
+        with self._lock:
+            return [event for position, event in self._rooms.get(room_id, [])
+                    if position > since and (until is None or position <= until)]
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+
+homeserver = FakeHomeserver()
+
+
+class FakeAsyncClient:
+    '''
+    Stand-in for nio.AsyncClient, with the part of it this project uses:
+    login, room_resolve_alias, room_send, room_messages, sync, logout and
+    close. Every request waits latency seconds (plus up to jitter more) and
+    fails with probability failure_rate, answering an error response as nio
+    does. expire_token makes every request fail as with an expired token
+    until the next login
+    '''
+
+    def __init__(self, homeserver_url, user, device_id=None, latency=0.0, jitter=0.0,
+                 failure_rate=0.0, server=homeserver):
+        self.homeserver = homeserver_url
+        self.user = user
+        self.user_id = user if user.startswith('@') else f'@{user}:fake'
+        self.device_id = device_id
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.server = server
+        self.access_token = ''
+        self.next_batch = None
+        self.requests = 0
+        self.failures = 0
+
+    def expire_token(self):
+        self.access_token = ''
+
+    async def _request(self, needs_token=True):
+        # returns the error response of a failed request, None if it goes on
+        self.requests += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if needs_token and not self.access_token:
+            self.failures += 1
+            return SimpleNamespace(status_code='M_UNKNOWN_TOKEN', message='Invalid access token')
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return SimpleNamespace(status_code='M_UNKNOWN', message='Injected failure')
+        return None
+
+    async def login(self, password=None, device_name=''):
+        error = await self._request(needs_token=False)
+        if error:
+            return error
+        self.device_id = self.device_id or f'FAKE{random.randrange(1 << 32):08X}'
+        self.access_token = f'fake_{self.device_id}_{time.time()}'
+        return SimpleNamespace(user_id=self.user_id, device_id=self.device_id,
+                               access_token=self.access_token)
+
+    async def room_resolve_alias(self, room_alias):
+        error = await self._request()
+        if error:
+            return error
+        return SimpleNamespace(room_alias=room_alias, room_id=self.server.resolve(room_alias),
+                               servers=['fake'])
+
+    async def room_send(self, room_id, message_type, content, tx_id=None, ignore_unverified_devices=False):
+        error = await self._request()
+        if error:
+            return error
+        event = self.server.publish(room_id, content.get('body', ''), self.user_id)
+        return SimpleNamespace(event_id=event.event_id, room_id=room_id)
+
+    async def room_messages(self, room_id, start, end=None, direction=None, limit=10, message_filter=None):
+        error = await self._request()
+        if error:
+            return error
+        # newest first, as the default backwards direction
+        chunk = self.server.events(room_id)[::-1][:limit]
+        return SimpleNamespace(room_id=room_id, chunk=chunk, start=start, end=str(self.server.position()))
+
+    async def sync(self, timeout=None, sync_filter=None, since=None, full_state=None, set_presence=None):
+        error = await self._request()
+        if error:
+            return error
+        room_filter = (sync_filter or {}).get('room', {})
+        since = since or self.next_batch
+        deadline = time.time() + (timeout or 0) / 1000
+        while True:
+            position = self.server.position()
+            rooms = room_filter.get('rooms') or self.server.rooms()
+            if since is None:
+                # initial sync, the last events of every room
+                limit = room_filter.get('timeline', {}).get('limit', 10)
+                timelines = {room_id: self.server.events(room_id, until=position)[-limit:] for room_id in rooms}
+            else:
+                timelines = {room_id: self.server.events(room_id, int(since), position) for room_id in rooms}
+            timelines = {room_id: events for room_id, events in timelines.items() if events}
+            if since is None or timelines or time.time() >= deadline:
+                break
+            await asyncio.sleep(POLL_INTERVAL)
+
+        self.next_batch = str(position)
+        join = {room_id: SimpleNamespace(timeline=SimpleNamespace(events=events, limited=False))
+                for room_id, events in timelines.items()}
+        return SimpleNamespace(next_batch=self.next_batch, rooms=SimpleNamespace(join=join, invite={}, leave={}))
+
+    async def logout(self, all_devices=False):
+        error = await self._request()
+        self.access_token = ''
+        return error or SimpleNamespace()
+
+    async def close(self):
+        pass
+
+
+def fake_client(server, user, device_id=None):
+    '''
+    Returns a fake client with the latency and failures of the configuration
+    '''
+    return FakeAsyncClient(server, user, device_id,
+                           latency=config('MATRIX_FAKE_LATENCY', default=0.0, cast=float),
+                           jitter=config('MATRIX_FAKE_JITTER', default=0.0, cast=float),
+                           failure_rate=config('MATRIX_FAKE_FAILURE_RATE', default=0.0, cast=float))
@@ -1,9 +1,10 @@
 import sys
 import os
 import time
+import signal
+import threading
 from datetime import datetime
 import numpy as np
-import face_recognition
 from cv2 import cv2
 from PIL import Image
 from decouple import config
@@ -12,11 +13,24 @@ import AccessControl.Data.enums as enums
 import AccessControl.Data.classes as classes
 import AccessControl.Data.data_manipulation as dm
 import AccessControl.Functions.matrix_functions as mx
-from tensorflow.keras.preprocessing.image import img_to_array
-from tensorflow.keras.applications.mobilenet_v2 import preprocess_input
-from tensorflow.keras.models import load_model
-from AccessControl.API.api import _set_appointment_status
+from AccessControl.Functions.gallery import Gallery
+from AccessControl.Functions.ann import IVFIndex
+from AccessControl.Functions.tracker import Tracker
+from AccessControl.Functions.capture import FrameGrabber
+from AccessControl.Functions.motion import MotionGate, parse_roi
+from AccessControl.Functions.preview import PreviewServer
+from AccessControl.Functions.scheduler import StageScheduler, parse_policy
+from AccessControl.Functions.temperature import TemperatureFeed
+from AccessControl.Functions.outbox import Outbox, DOOR, PROMPT
+from AccessControl.Functions.mask_backends import load_mask_model, preprocess, INPUT_SIZE
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+_face_net_lock = threading.Lock()
+# buffers reused by each inference thread, see _thread_buffer
+_buffers = threading.local()
+CONFIDENCE = 0.5
 
 
 def get_mask_face_net(face, model):
@@ -25,8 +39,9 @@ def get_mask_face_net(face, model):
     weightsPath = os.path.sep.join([os.path.abspath(face),
                                     "res10_300x300_ssd_iter_140000.caffemodel"])
     faceNet = cv2.dnn.readNet(prototxtPath, weightsPath)
-    # load the face mask detector model from disk
-    maskNet = load_model(os.path.abspath(model))
+    # load the face mask detector model from disk, a .tflite file is run
+    # with the light TFLite runtime instead of TensorFlow
+    maskNet = load_mask_model(model)
 
     return maskNet, faceNet
 
@@ -36,113 +51,187 @@ def has_time_passed(time_since, interval):
     return (time.time() - time_since) > interval
 
 
-def detect_and_predict_mask(frame, faceNet, maskNet):
+def _thread_buffer(name, shape, dtype='uint8'):
+    '''
+    Returns an array of the given shape, a view on a buffer of the calling
+    thread. The buffer is allocated again only when it is too short or the
+    rest of the shape changes
+    '''
+    buffer = getattr(_buffers, name, None)
+    if buffer is None or len(buffer) < shape[0] or buffer.shape[1:] != shape[1:] or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+        setattr(_buffers, name, buffer)
+    return buffer[:shape[0]]
+
+
+def detect_faces(frame, faceNet, scale=None):
     # grab the dimensions of the frame and then construct a blob
     # from it
     (h, w) = frame.shape[:2]
-    blob = cv2.dnn.blobFromImage(frame, 1.0, (300, 300), (104.0, 177.0, 123.0))
-
-    # pass the blob through the network and obtain the face detections
-    faceNet.setInput(blob)
-    detections = faceNet.forward()
-
-    # initialize our list of faces, their corresponding locations,
-    # and the list of predictions from our face mask network
-    faces = []
-    locs = []
-    preds = []
-
-    # loop over the detections
-    for i in range(detections.shape[2]):
-        # extract the confidence (i.e., probability) associated with
-        # the detection
-        confidence = detections[0, 0, i, 2]
-
-        # filter out weak detections by ensuring the confidence is
-        # greater than the minimum confidence
-        if confidence > 0.5:
-            # compute the (x, y)-coordinates of the bounding box for
-            # the object
-            box = detections[0, 0, i, 3:7] * np.array([w, h, w, h])
-            (startX, startY, endX, endY) = box.astype("int")
-
-            # ensure the bounding boxes fall within the dimensions of
-            # the frame
-            (startX, startY) = (max(0, startX), max(0, startY))
-            (endX, endY) = (min(w - 1, endX), min(h - 1, endY))
-
-            # extract the face ROI, convert it from BGR to RGB channel
-            # ordering, resize it to 224x224, and preprocess it
-            face = frame[startY:endY, startX:endX]
-            face = cv2.cvtColor(face, cv2.COLOR_BGR2RGB)
-            face = cv2.resize(face, (224, 224))
-            face = img_to_array(face)
-            face = preprocess_input(face)
-
-            # add the face and bounding boxes to their respective
-            # lists
-            faces.append(face)
-            locs.append((startX, startY, endX, endY))
-
+    if scale:
+        # the detector runs on a downscaled copy at its own size, so its cost
+        # depends on the configured scale and not on the camera resolution.
+        # Detections are relative to the image, so boxes map back to the
+        # full resolution frame as they are
+        small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        size = (small.shape[1], small.shape[0])
+        blob = cv2.dnn.blobFromImage(small, 1.0, size, (104.0, 177.0, 123.0))
+    else:
+        blob = cv2.dnn.blobFromImage(frame, 1.0, (300, 300), (104.0, 177.0, 123.0))
+
+    # pass the blob through the network and obtain the face detections.
+    # The network keeps its input, so cameras sharing it take turns
+    with _face_net_lock:
+        faceNet.setInput(blob)
+        detections = faceNet.forward()
+
+    # rows are (_, _, confidence, startX, startY, endX, endY), coordinates
+    # relative to the image. Weak detections are filtered out and the boxes
+    # scaled to the frame and clipped to it, all at once
+    detections = detections[0, 0]
+    detections = detections[detections[:, 2] > CONFIDENCE]
+    boxes = (detections[:, 3:7] * np.array([w, h, w, h])).astype('int')
+    np.clip(boxes, 0, [w - 1, h - 1, w - 1, h - 1], out=boxes)
+
+    # boxes left empty after clipping have no face to work with
+    boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+
+    # locations as (startX, startY, endX, endY)
+    return [tuple(box) for box in boxes.tolist()]
+
+
+def predict_masks(frame, locs, maskNet):
     # only make a predictions if at least one face was detected
-    if faces:
-        # for faster inference we'll make batch predictions on *all*
-        # faces at the same time rather than one-by-one predictions
-        # in the above `for` loop
-        faces = np.array(faces, dtype="float32")
-        preds = maskNet.predict(faces, batch_size=32)
+    if not locs:
+        return []
+
+    # every face is written straight into its slot of the batch, the
+    # buffers are the same for every call of the thread
+    batch = _thread_buffer('batch', (len(locs),) + INPUT_SIZE + (3,), 'float32')
+    resized = _thread_buffer('resized', INPUT_SIZE + (3,))
+    rgb = _thread_buffer('face', INPUT_SIZE + (3,))
+    for face, (startX, startY, endX, endY) in zip(batch, locs):
+        # resize the face ROI to 224x224, convert it from BGR to RGB channel
+        # ordering, and preprocess it
+        cv2.resize(frame[startY:endY, startX:endX], INPUT_SIZE, dst=resized)
+        cv2.cvtColor(resized, cv2.COLOR_BGR2RGB, dst=rgb)
+        preprocess(rgb, out=face)
+
+    # for faster inference we'll make batch predictions on *all*
+    # faces at the same time rather than one-by-one predictions
+    return maskNet.predict(batch, batch_size=32)
+
+
+def detect_and_predict_mask(frame, faceNet, maskNet, scale=None):
+    locs = detect_faces(frame, faceNet, scale)
+    preds = predict_masks(frame, locs, maskNet)
 
     # return a 2-tuple of the face locations
     # and their corresponding predictions
     return (locs, preds)
 
 
-async def has_mask(frame, faceNet, maskNet):
-    has_mask = None
-    _, preds = detect_and_predict_mask(frame, faceNet, maskNet)
+def to_dlib_locations(locs):
+    # face_recognition takes boxes as (top, right, bottom, left)
+    return [(int(startY), int(endX), int(endY), int(startX)) for (startX, startY, endX, endY) in locs]
+
 
-    if len(preds) > 0:
-        # each pred is a tuple of probability of having and not having mask.
-        # Only first face is taken
-        mask, without_mask = preds[0]
-        has_mask = mask > without_mask
-    # True means it has mask, False means it doesn't
-    # None means there's no face on the picture
-    return has_mask
+def classify_masks(frame, locs, maskNet):
+    preds = predict_masks(frame, locs, maskNet)
 
+    # each pred is a tuple of probability of having and not having mask.
+    # Returns has_mask for every location, True means it has mask,
+    # False means it doesn't
+    return [mask > without_mask for mask, without_mask in preds]
 
-async def face_recog(frame, encodings):
-    rgb_frame = frame[:, :, ::-1]
-    face_locations = face_recognition.face_locations(rgb_frame)
+
+def recognize_faces(frame, gallery, locs):
+    # face_recognition loads the dlib models on import, warm_up takes that cost
+    import face_recognition
+
+    # locs are the boxes found by the mask detection on the same frame,
+    # so there is no second detection pass
+    # dlib takes a contiguous RGB image, converted into the buffer of the
+    # thread instead of copying a reversed view on every call
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=_thread_buffer('rgb', frame.shape))
+    # every face is encoded and matched in the same batch
     unknown_face_encondings = face_recognition.face_encodings(
-        rgb_frame, face_locations)
-    result = False
-    best_match_index = 0
-    unknown_face_enconding = None
-    if unknown_face_encondings:
-        unknown_face_enconding = unknown_face_encondings[0]
-        tolerance = 0.5
-        results = face_recognition.compare_faces(
-            encodings, unknown_face_enconding, tolerance)
-        face_distances = face_recognition.face_distance(
-            encodings, unknown_face_enconding)
-        if len(face_distances) > 0:
-            best_match_index = np.argmin(face_distances)
-            result = results[best_match_index]
-
-    return (result, best_match_index, unknown_face_enconding, rgb_frame)
-
-
-async def temp_okay(client, acceptable_time, room_id):
-    data = await mx.matrix_get_messages(client, room_id)
+        rgb_frame, known_face_locations=to_dlib_locations(locs))
+    matches = gallery.best_matches(unknown_face_encondings)
+
+    # tuples (result, person_id, face_encoding), one per location
+    faces = [(result, person_id, encoding)
+             for (result, person_id, _), encoding in zip(matches, unknown_face_encondings)]
+    return faces
+
+
+def warm_up(faceNet, maskNet, galleries=(), scale=None, size=(480, 640)):
+    '''
+    Runs every model once on a dummy frame, so the first camera frame does
+    not pay for importing, loading and initializing them.
+    Returns dict stage -> seconds it took
+    '''
+    import face_recognition
+
+    timings = {}
+    frame = np.zeros(size + (3,), dtype='uint8')
+    location = (size[1] // 4, size[0] // 4, size[1] * 3 // 4, size[0] * 3 // 4)
+
+    start = time.perf_counter()
+    detect_faces(frame, faceNet, scale)
+    timings['detect'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    classify_masks(frame, [location], maskNet)
+    timings['mask'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    encodings = face_recognition.face_encodings(
+        frame, known_face_locations=to_dlib_locations([location]))
+    for gallery in galleries:
+        gallery.best_matches(encodings)
+    timings['recognition'] = time.perf_counter() - start
+    return timings
+
+
+def print_startup(phases):
+    '''
+    Prints the seconds each startup phase took, phases is a list of
+    (name, seconds)
+    '''
+    total = sum(seconds for _, seconds in phases)
+    details = ', '.join(f'{name}: {seconds:.2f}s' for name, seconds in phases)
+    print(f'Started in {total:.2f}s... {details}')
+
+
+# inference is CPU bound, the coroutines below run it on an executor so the
+# event loop stays free for the Matrix client while it runs. OpenCV, dlib and
+# TensorFlow release the GIL, so a thread pool is enough to run stages at once
+
+async def find_faces(frame, faceNet, scale=None, executor=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, detect_faces, frame, faceNet, scale)
+
+
+async def has_mask(frame, locs, maskNet, executor=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, classify_masks, frame, locs, maskNet)
+
+
+async def face_recog(frame, gallery, locs, executor=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, recognize_faces, frame, gallery, locs)
+
+
+def temp_okay(feed, acceptable_time):
+    # the feed keeps the last reading of the sensor, there is no network call
     good_value_flag = False
     answer = None
     temp = 0
     timestamp = 0
-    if data:
-        last_entry = data[-1]
+    if feed.latest:
         try:
-            info, timestamp, _ = last_entry
+            info, timestamp = feed.latest
             temp = float(info)
             good_value_flag = True
         except ValueError:
@@ -153,8 +242,6 @@ async def temp_okay(client, acceptable_time, room_id):
 
             answer = temp < temp_threshold
 
-        data.clear()
-
     return (answer, temp)
 
 
@@ -165,36 +252,105 @@ def get_start_end_time():
     conf = crud.get_config()
     return conf.start_time, conf.end_time
 
+def get_gallery_index():
+    # exact scan unless an approximate index is configured
+    if config('GALLERY_INDEX', default='exact') != 'ivf':
+        return None
+    return IVFIndex(nlist=config('IVF_NLIST', default=0, cast=int),
+                    nprobe=config('IVF_NPROBE', default=8, cast=int),
+                    min_size=config('IVF_MIN_SIZE', default=2000, cast=int))
+
+
 def get_pictures_profile(profile):
+    # arrays come straight from the memory-mapped encoding cache
+    person_ids, encodings, pic_ids = dm.get_pictures_arrays_by_type(profile)
 
-    pics = dm.get_pictures_encodings_by_type(profile)
+    return Gallery(person_ids, encodings, pic_ids, get_gallery_index(),
+                   exemplars=config('GALLERY_EXEMPLARS', default=3, cast=int),
+                   margin=config('GALLERY_AMBIGUITY_MARGIN', default=0.1, cast=float))
 
-    # list of tuples (person_id, face_enconding)
-    person_ids = []
-    encodings = []
-    for person_id, encoding, _ in pics:
-        person_ids.append(person_id)
-        encodings.append(encoding)
 
-    return person_ids, encodings
+def refresh_gallery(gallery, profile):
+    '''
+    Patches the gallery in place with the pictures added to or removed from
+    the profile since the last refresh. Pictures of deactivated persons or
+    finished appointments are removed, only new encodings are deserialized
+    '''
+    current_ids = set(dm.get_pictures_ids_by_type(profile))
+    known_ids = set(gallery.pic_ids.tolist())
+
+    gallery.remove(known_ids - current_ids)
+    added_ids = current_ids - known_ids
+    if added_ids:
+        # a camera may have added some of them since known_ids was read
+        gallery.replace(*dm.get_pictures_arrays_by_ids(added_ids))
+
+    return gallery
 
-async def send_audio_messages(messages, client, speaker_room_id):
-    message_task = asyncio.create_task(mx.matrix_send_message(
-        client, speaker_room_id, '\n'.join(messages)))
-    await message_task
-    print(messages)
 
+def get_galleries():
+    # one gallery per profile, so switching profiles needs no reload
+    return {profile: get_pictures_profile(profile)
+            for profile in enums.PictureClassification}
 
-async def face_recog_live(faceNet, maskNet, camera):
-    video_capture = cv2.VideoCapture(camera.connection_string())  # starting camera
 
-    time_mask_detection = time.time()
-    time_face_recognition = time.time()
+def refresh_galleries(galleries):
+    for profile, gallery in galleries.items():
+        refresh_gallery(gallery, profile)
+
+def send_audio_messages(messages, outbox, speaker_room_id):
+    # queued on the outbox, repeated prompts are coalesced there
+    for message in messages:
+        outbox.send(speaker_room_id, message)
+    print(messages)
+
+
+def get_preview():
+    '''
+    Returns the MJPEG debug preview server, started, if PREVIEW_PORT is set
+    '''
+    port = config('PREVIEW_PORT', default=0, cast=int)
+    if not port:
+        return None
+    preview = PreviewServer(config('PREVIEW_HOST', default='127.0.0.1'), port,
+                            config('PREVIEW_FPS', default=2, cast=float)).start()
+    print(preview)
+    return preview
+
+
+async def run_until_signal(coroutine):
+    '''
+    Runs the coroutine until it ends or the process gets SIGINT or SIGTERM,
+    then cancels it so its cleanup (cameras, executors, clients) runs
+    '''
+    loop = asyncio.get_running_loop()
+    task = asyncio.ensure_future(coroutine)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, task.cancel)
+    try:
+        return await task
+    except asyncio.CancelledError:
+        print('Shutting down')
+    finally:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+
+
+async def face_recog_live(faceNet, maskNet, camera, executor=None, galleries=None,
+                          headless=False, preview=None, grabber=None, scheduler=None):
+    # headless runs make no GUI calls at all, they are stopped with a signal.
+    # preview is an optional PreviewServer the frames are offered to.
+    # The replay passes its own frame source and scheduler
+    # starting camera, frames are read on their own thread
+    if grabber is None:
+        grabber = FrameGrabber(camera.connection_string(),
+                               config('FRAME_BUFFER_SIZE', default=2, cast=int))
+    grabber.start()
+
+    time_detection = time.time()
     time_temp_comprobation = time.time()
-    time_since_mask = time.time()
-    time_since_face = time.time()
     time_profile = time.time()
-    time_welcomed = time.time()
+    time_config = time.time()
 
     server = config('MATRIX_SERVER')
     user = config('MATRIX_USER')
@@ -208,148 +364,245 @@ async def face_recog_live(faceNet, maskNet, camera):
     temper_room_id = await mx.matrix_get_room_id(client, temper_room_name)
     speaker_room_id = await mx.matrix_get_room_id(client, speaker_room_name)
     door_room_id = await mx.matrix_get_room_id(client, door_room_name)
+    # messages are sent in the background, door commands first
+    outbox = (Outbox(client, config('OUTBOX_SIZE', default=64, cast=int))
+              .add_room(door_room_id, DOOR)
+              .add_room(speaker_room_id, PROMPT, config('PROMPT_WINDOW', default=5, cast=float)))
+    # readings of the sensor are followed as they come
+    temperature = TemperatureFeed(client, temper_room_id).start() if camera.ask_temp else None
 
-    mask_detection_flag = False
-    face_recognition_flag = False
     temp_comprobation_flag = False
 
-    MASK_DETECT_INTERVAL = 5
-    FACE_RECOG_INTERVAL = 8
-    TEMP_COMPROBATION_INTERVAL = 5
-    TIME_START_AGAIN = 13
-    WINDOW_TIME_SINCE = 30
-    PROFILE_INTERVAL = 60*1
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(config('INFERENCE_WORKERS', default=2, cast=int))
+    loop = asyncio.get_running_loop()
+
+    PROFILE_INTERVAL = 60
+    CONFIG_INTERVAL = 5
     ACCEPTABLE_TIME_TEMP = 32
 
+    # when each stage runs is up to the scheduler, with the interval policy
+    # of the camera over the one of the environment
+    if scheduler is None:
+        scheduler = StageScheduler(
+            parse_policy(config('STAGE_POLICY', default=''), camera.stage_policy),
+            config('CPU_BUDGET', default=0.75, cast=float))
+
     messages = []
-    message_task = None
+
+    # every face in front of the camera is a track with its own decision state
+    tracker = Tracker()
+    # person id -> time the door was last decided for them, a person whose
+    # track was lost and found again is not welcomed twice
+    welcomed = {}
+    # nothing runs on frames without motion, unless there are faces being tracked.
+    # Cameras without a threshold of their own take the one of the environment
+    motion_threshold = camera.motion_threshold
+    if motion_threshold is None:
+        motion_threshold = config('MOTION_THRESHOLD', default=0.01, cast=float)
+    motion_gate = None
+    if motion_threshold > 0:
+        motion_gate = MotionGate(motion_threshold, parse_roi(camera.motion_roi))
 
     profile = get_profile()
-    person_ids, encodings = get_pictures_profile(profile)
+    # galleries given by the supervisor are shared and refreshed by it
+    own_galleries = galleries is None
+    if own_galleries:
+        galleries = get_galleries()
+    gallery = galleries[profile]
     start_time, end_time = get_start_end_time()
-    print(person_ids)
-    while True:
-        time.sleep(0.02)
-        _, frame = video_capture.read()  # getting frame
-        try:
-            cv2.imshow('Video', frame)  # showing video
-        except:
-            pass
-
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            break
-
-        mask = None
-        if messages:
-            await send_audio_messages(messages, client, speaker_room_id)
-            messages.clear()
-
-        if has_time_passed(time_profile, PROFILE_INTERVAL):
-            profile = get_profile()
-            person_ids, encodings = get_pictures_profile(profile)
-            start_time, end_time = get_start_end_time()
-            time_profile = time.time()
-            print(person_ids)
-        if has_time_passed(time_since_mask, WINDOW_TIME_SINCE):
-            mask_detection_flag = False
-        if has_time_passed(time_mask_detection, MASK_DETECT_INTERVAL):
-            has_mask_task = asyncio.create_task(
-                has_mask(frame, faceNet, maskNet))
-            mask = await has_mask_task
-            time_mask_detection = time.time()
-
-        # if time since last welcome is less than TIME_START_AGAIN,
-        # continue with the loop
-        if not has_time_passed(time_welcomed, TIME_START_AGAIN):
-            continue
-
-
-
-        if mask is None:  # if no face was detected, get another frame
-            continue
-
-        if (
-            not start_time < datetime.now().time() < end_time
-            and camera.entry_type == enums.EntryTypes.ENTRY
-        ):
-            messages.append('10Time')
-            continue
-
-
-        if mask:
-            mask_detection_flag = True
-            time_since_mask = time.time()
-            if not face_recognition_flag:
-                messages.append('1MaskWasDetected')
-        elif has_time_passed(time_face_recognition, FACE_RECOG_INTERVAL) and not face_recognition_flag or has_time_passed(time_face_recognition, FACE_RECOG_INTERVAL*4):
-            face_recog_task = asyncio.create_task(face_recog(
-                frame, encodings))
-            face_recognition_flag, best_match_index, unknown_face_encoding, rgb_frame = await face_recog_task
-            if face_recognition_flag:
-                p_id = person_ids[best_match_index]
-
-                now = time.strftime(
-                    "%Y-%m-%d %H:%M:%S", time.localtime())
-                person = crud.get_entry(classes.Person, p_id)
-
-                print(f'{person}, {now}')
-                messages.append('2PersonWasRecognized')
-
-                face_recognition_flag = True
-                time_since_face = time.time()
-                if mask_detection_flag:
-                    messages.append('3PutMaskOn')
-                elif camera.ask_mask:
-                    messages.append('4MaskWasNotDetected')
-            else:
-                messages.append('6UnknownPerson')
-        elif face_recognition_flag and mask == False:
-            messages.append('4MaskWasNotDetected')
-
-
-        if has_time_passed(time_temp_comprobation, TEMP_COMPROBATION_INTERVAL) and camera.ask_temp:
-            temp_okay_task = asyncio.create_task(
-                temp_okay(client, ACCEPTABLE_TIME_TEMP, temper_room_id))
-            temp_comprobation_flag, _ = await temp_okay_task
-            time_temp_comprobation = time.time()
-
-            if temp_comprobation_flag is False:
-                messages.append('7TempIsGreater')
-            elif temp_comprobation_flag is None:
-                messages.append('8TakeTempSens')
-
-        print(face_recognition_flag, mask_detection_flag, temp_comprobation_flag)
-        if face_recognition_flag and (mask_detection_flag or not camera.ask_mask) and (temp_comprobation_flag or not camera.ask_temp):
-            open_door = True
-            if profile == enums.PictureClassification.ACCEPTED_APPOINTMENTS:
-                available_appointment = dm.has_available_appointment(p_id, camera.entry_type)
-                open_door = bool(available_appointment)
-                if open_door:
-                    status = enums.AppointmentStatus.ONGOING if camera.entry_type == enums.EntryTypes.ENTRY else enums.AppointmentStatus.FINALIZED
-                    _set_appointment_status(available_appointment, status)
-            if open_door :
-                await mx.matrix_send_message(client, door_room_id, '1')
-                messages.append('5Welcome')
-                if crud.is_last_entry_equal(p_id, camera.entry_type):
-                    dm.fix_entry(p_id, camera.entry_type)
-                dm.insert_picture_discovered(
-                    p_id, rgb_frame, unknown_face_encoding, camera.entry_type.name)
-            else:
-                messages.append('9Appointment')
-
-            mask_detection_flag = False
-            face_recognition_flag = False
-            temp_comprobation_flag = False
-
-            time_mask_detection = time.time()
-            time_face_recognition = time.time()
-            time_temp_comprobation = time.time()
-            time_since_mask = time.time()
-            time_since_face = time.time()
-            time_welcomed = time.time()
-
+    print(gallery)
     try:
-        video_capture.release()
-        cv2.destroyAllWindows()
-    except:
-        pass
+        while True:
+            # getting newest frame, waiting for it off the event loop
+            ok, frame = await loop.run_in_executor(None, grabber.read)
+            if not ok:
+                continue
+            if not headless:
+                cv2.imshow(f'Video {camera.id}', frame)  # showing video
+                if cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+            if preview:
+                preview.publish(camera.id, frame, [track.location for track in tracker.tracks])
+
+            if messages:
+                send_audio_messages(messages, outbox, speaker_room_id)
+                messages.clear()
+
+            if has_time_passed(time_config, CONFIG_INTERVAL):
+                crud.expire_all()
+                profile = get_profile()
+                gallery = galleries[profile]
+                start_time, end_time = get_start_end_time()
+                time_config = time.time()
+            if has_time_passed(time_profile, PROFILE_INTERVAL):
+                if own_galleries:
+                    refresh_galleries(galleries)
+                time_profile = time.time()
+                print(gallery)
+                print(grabber)
+                print(scheduler)
+                print(outbox)
+                if temperature:
+                    print(temperature)
+                if motion_gate:
+                    print(motion_gate)
+
+            scheduler.update()
+            if not scheduler.due('detect', time_detection):
+                continue
+            if motion_gate and not tracker.tracks and not motion_gate.check(frame):
+                time_detection = time.time()
+                continue
+            locs = await scheduler.run('detect', find_faces(frame, faceNet, camera.detection_scale, executor))
+            tracks = tracker.update(locs, scheduler.interval('detect'))
+            time_detection = time.time()
+
+            for track in tracks:
+                if scheduler.due('mask_window', track.time_since_mask):
+                    track.mask_detection_flag = False
+
+            # faces welcomed a moment ago are left alone
+            present = [track for track in tracks
+                       if scheduler.due('start_again', track.time_welcomed)]
+            # the mask classifier runs as soon as a face shows up and then
+            # again at the mask interval, recognition waits for it
+            checked = [track for track in present
+                       if scheduler.due('mask', track.time_mask_detection)]
+
+            if (
+                checked
+                and not start_time < datetime.now().time() < end_time
+                and camera.entry_type == enums.EntryTypes.ENTRY
+            ):
+                messages.append('10Time')
+                for track in checked:
+                    track.time_mask_detection = time.time()
+                checked = []
+
+            if checked:
+                # a face is recognized once, and verified again at a low rate.
+                # Recognition runs along with the mask classification, its result
+                # is only used for the faces found without mask. Faces last seen
+                # with mask wait until the classifier finds them without it
+                to_recognize = [track for track in checked
+                                if not track.mask
+                                and (scheduler.due('recognition', track.time_face_recognition) and not track.face_recognition_flag
+                                     or has_time_passed(track.time_face_recognition, scheduler.interval('recognition')*4))]
+                has_mask_task = asyncio.create_task(scheduler.run('mask', has_mask(
+                    frame, [track.location for track in checked], maskNet, executor)))
+                face_recog_task = None
+                if to_recognize:
+                    face_recog_task = asyncio.create_task(scheduler.run('recognition', face_recog(
+                        frame, gallery, [track.location for track in to_recognize], executor)))
+
+                for track, mask in zip(checked, await has_mask_task):
+                    track.mask = mask
+                    track.time_mask_detection = time.time()
+
+                for track in checked:
+                    if track.mask:
+                        track.mask_detection_flag = True
+                        track.time_since_mask = time.time()
+                        if not track.face_recognition_flag:
+                            messages.append('1MaskWasDetected')
+                    elif track.face_recognition_flag and track not in to_recognize:
+                        messages.append('4MaskWasNotDetected')
+
+                if face_recog_task:
+                    recognized = await face_recog_task
+
+                    for track, (result, p_id, unknown_face_encoding) in zip(to_recognize, recognized):
+                        track.time_face_recognition = time.time()
+                        if track.mask:
+                            continue
+                        if result and not scheduler.due('start_again', welcomed.get(p_id, 0)):
+                            # decided a moment ago on an earlier track
+                            track.person_id = p_id
+                            track.time_welcomed = welcomed[p_id]
+                            continue
+                        track.face_recognition_flag = result
+                        if result:
+                            track.person_id = p_id
+                            track.encoding = unknown_face_encoding
+                            track.frame = frame
+
+                            now = time.strftime(
+                                "%Y-%m-%d %H:%M:%S", time.localtime())
+                            person = crud.get_entry(classes.Person, p_id)
+
+                            print(f'{person}, {now}')
+                            messages.append('2PersonWasRecognized')
+
+                            if track.mask_detection_flag:
+                                messages.append('3PutMaskOn')
+                            elif camera.ask_mask:
+                                messages.append('4MaskWasNotDetected')
+                        else:
+                            messages.append('6UnknownPerson')
+
+                for track in checked:
+                    print(track)
+
+            # the sensor is read only while someone at the door waits for it
+            waiting_temp = [track for track in present if not track.temp_comprobation_flag]
+            if camera.ask_temp and waiting_temp and scheduler.due('temperature', time_temp_comprobation):
+                with scheduler.timed('temperature'):
+                    temp_comprobation_flag, _ = temp_okay(temperature, ACCEPTABLE_TIME_TEMP)
+                time_temp_comprobation = time.time()
+
+                # there is one sensor, its reading goes to every face at the door
+                for track in present:
+                    track.temp_comprobation_flag = temp_comprobation_flag
+
+                if temp_comprobation_flag is False:
+                    messages.append('7TempIsGreater')
+                elif temp_comprobation_flag is None:
+                    messages.append('8TakeTempSens')
+
+            for track in present:
+                if track.face_recognition_flag and (track.mask_detection_flag or not camera.ask_mask) and (track.temp_comprobation_flag or not camera.ask_temp):
+                    p_id = track.person_id
+                    open_door = True
+                    if profile == enums.PictureClassification.ACCEPTED_APPOINTMENTS:
+                        available_appointment = dm.has_available_appointment(p_id, camera.entry_type)
+                        open_door = bool(available_appointment)
+                        if open_door:
+                            status = enums.AppointmentStatus.ONGOING if camera.entry_type == enums.EntryTypes.ENTRY else enums.AppointmentStatus.FINALIZED
+                            crud.set_appointment_status(available_appointment, status)
+                    if open_door :
+                        outbox.send(door_room_id, '1')
+                        # door latency, from the face showing up to the door opening
+                        scheduler.record('door', time.time() - track.first_seen)
+                        messages.append('5Welcome')
+                        if crud.is_last_entry_equal(p_id, camera.entry_type):
+                            dm.fix_entry(p_id, camera.entry_type)
+                        picture = dm.insert_picture_discovered(
+                            p_id, cv2.cvtColor(track.frame, cv2.COLOR_BGR2RGB), track.encoding,
+                            camera.entry_type.name)
+                        # the refresh may add the same picture, replace keeps one copy
+                        gallery.replace([p_id], [track.encoding], [picture.id])
+                    else:
+                        messages.append('9Appointment')
+
+                    track.reset()
+                    welcomed = {person: at for person, at in welcomed.items()
+                                if not scheduler.due('start_again', at)}
+                    welcomed[track.person_id] = track.time_welcomed
+                    time_temp_comprobation = time.time()
+    finally:
+        # also reached when the supervisor cancels the camera
+        grabber.stop()
+        if temperature:
+            await temperature.stop()
+        await outbox.close()
+        await client.close()
+        if own_executor:
+            executor.shutdown(wait=False)
+        if not headless:
+            # the window does not exist if no frame was shown yet
+            try:
+                cv2.destroyWindow(f'Video {camera.id}')
+            except cv2.error:
+                pass
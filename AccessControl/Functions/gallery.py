@@ -0,0 +1,257 @@
+import functools
+import threading
+import numpy as np
+
+
+ENCODING_SIZE = 128  # length of the encodings given by face_recognition
+TOLERANCE = 0.5
+AMBIGUITY_MARGIN = 0.1
+
+
+def _locked(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class Gallery:
+    '''
+    In-memory index of the face encodings of a profile.
+    Encodings are kept as one contiguous float32 matrix with parallel
+    arrays of person ids and picture ids, so every lookup is a single
+    distance pass instead of one per comparison function.
+    The arrays are over-allocated, so pictures can be added and removed
+    in place without rebuilding the whole gallery.
+    An approximate index (see ann.IVFIndex) can be given to narrow down
+    the rows scanned on big galleries.
+    With exemplars, faces are first matched against a few prototypes per
+    person (their centroid and the most diverse encodings), so lookups are
+    bounded by persons instead of pictures. Matches whose distance is within
+    margin of the tolerance are checked again against every picture.
+    Galleries can be shared between threads, every public method holds the
+    gallery lock.
+    '''
+
+    def __init__(self, person_ids=(), encodings=(), pic_ids=(), index=None,
+                 exemplars=0, margin=AMBIGUITY_MARGIN):
+        self._lock = threading.RLock()
+        self.index = index
+        self.exemplars = exemplars
+        self.margin = margin
+        self._prototypes = None
+        self._dirty_persons = set()
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        self._size = 0
+        self._person_ids = np.empty(0, dtype=np.int64)
+        self._pic_ids = np.empty(0, dtype=np.int64)
+        self._encodings = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self._norms = np.empty(0, dtype=np.float32)
+        self.add(person_ids, encodings, pic_ids)
+
+    @property
+    def person_ids(self):
+        return self._person_ids[:self._size]
+
+    @property
+    def pic_ids(self):
+        return self._pic_ids[:self._size]
+
+    @property
+    def encodings(self):
+        return self._encodings[:self._size]
+
+    def __len__(self):
+        return self._size
+
+    def __str__(self) -> str:
+        return f'Gallery... pictures: {len(self)}, persons: {len(np.unique(self.person_ids))}'
+
+    def _reserve(self, size):
+        capacity = len(self._pic_ids)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 64)
+        for name in ('_person_ids', '_pic_ids', '_norms'):
+            old = getattr(self, name)
+            new = np.empty(capacity, dtype=old.dtype)
+            new[:self._size] = old[:self._size]
+            setattr(self, name, new)
+        encodings = np.empty((capacity, ENCODING_SIZE), dtype=np.float32)
+        encodings[:self._size] = self._encodings[:self._size]
+        self._encodings = encodings
+
+    @_locked
+    def add(self, person_ids, encodings, pic_ids):
+        '''
+        Appends encodings to the gallery, along with their person and picture ids
+        '''
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        count = len(encodings)
+        if not count:
+            return
+        start, end = self._size, self._size + count
+        self._reserve(end)
+        self._person_ids[start:end] = person_ids
+        self._pic_ids[start:end] = pic_ids
+        self._encodings[start:end] = encodings
+        # squared norms are cached so distances only need one matrix product
+        self._norms[start:end] = np.einsum('ij,ij->i', encodings, encodings)
+        self._size = end
+        if self.index is not None:
+            self.index.add(encodings)
+        if self.exemplars:
+            self._dirty_persons.update(np.atleast_1d(person_ids).tolist())
+
+    @_locked
+    def remove(self, pic_ids):
+        '''
+        Removes from the gallery the encodings of the given pictures
+        '''
+        if not len(pic_ids) or not self._size:
+            return
+        self._keep(~np.isin(self.pic_ids, np.fromiter(pic_ids, dtype=np.int64)))
+
+    @_locked
+    def replace(self, person_ids, encodings, pic_ids):
+        '''
+        Adds the encodings in place of any the gallery had for the same
+        pictures, so adding a picture twice keeps one copy
+        '''
+        self.remove(np.atleast_1d(pic_ids))
+        self.add(person_ids, encodings, pic_ids)
+
+    @_locked
+    def remove_persons(self, person_ids):
+        '''
+        Removes from the gallery every encoding of the given persons
+        '''
+        if not len(person_ids) or not self._size:
+            return
+        self._keep(~np.isin(self.person_ids, np.fromiter(person_ids, dtype=np.int64)))
+
+    def _keep(self, keep):
+        if self.exemplars:
+            self._dirty_persons.update(self.person_ids[~keep].tolist())
+        size = int(keep.sum())
+        for name in ('_person_ids', '_pic_ids', '_norms', '_encodings'):
+            array = getattr(self, name)
+            array[:size] = array[:self._size][keep]
+        self._size = size
+        if self.index is not None:
+            self.index.remove(keep)
+
+    @_locked
+    def distances(self, encoding, rows=None):
+        '''
+        Returns the euclidean distance from the encoding to every encoding in the gallery,
+        or only to the given rows
+        '''
+        encoding = np.asarray(encoding, dtype=np.float32)
+        norms, encodings = self._norms[:self._size], self.encodings
+        if rows is not None:
+            norms, encodings = norms[rows], encodings[rows]
+        squared = norms - 2 * (encodings @ encoding) + encoding @ encoding
+        return np.sqrt(np.maximum(squared, 0))
+
+    def _candidates(self, encoding):
+        # rows to scan, all of them when there is no index or the gallery is small
+        if self.index is None:
+            return None
+        return self.index.candidates(np.asarray(encoding, dtype=np.float32), self.encodings)
+
+    def _get_prototypes(self):
+        # prototypes are only rebuilt for the persons whose pictures changed
+        if self._prototypes is None:
+            self._prototypes = Gallery()
+            self._dirty_persons = set(self.person_ids.tolist())
+        if not self._dirty_persons:
+            return self._prototypes
+
+        dirty = np.fromiter(self._dirty_persons, dtype=np.int64)
+        self._prototypes.remove_persons(dirty)
+        rows = np.flatnonzero(np.isin(self.person_ids, dirty))
+        rows = rows[np.argsort(self.person_ids[rows], kind='stable')]
+        bounds = np.flatnonzero(np.diff(self.person_ids[rows])) + 1
+        for group in np.split(rows, bounds):
+            if len(group):
+                self._prototypes.add(*self._person_prototypes(group))
+        self._dirty_persons.clear()
+        return self._prototypes
+
+    def _person_prototypes(self, rows):
+        '''
+        Returns (person_ids, encodings, pic_ids) with the centroid and the exemplars
+        of the pictures on the given rows, all of them of the same person.
+        Exemplars are picked by farthest point sampling, the centroid gets
+        the negative person id as picture id
+        '''
+        person_id = int(self.person_ids[rows[0]])
+        encodings = self.encodings[rows]
+        centroid = encodings.mean(axis=0)
+        chosen = []
+        nearest = np.linalg.norm(encodings - centroid, axis=1)
+        for _ in range(min(self.exemplars, len(rows))):
+            farthest = int(np.argmax(nearest))
+            chosen.append(farthest)
+            nearest = np.minimum(nearest, np.linalg.norm(encodings - encodings[farthest], axis=1))
+        return ([person_id] * (len(chosen) + 1),
+                np.vstack((centroid, encodings[chosen])),
+                [-person_id] + self.pic_ids[rows][chosen].tolist())
+
+    @_locked
+    def search(self, encoding, k=1, tolerance=TOLERANCE):
+        '''
+        Returns up to k tuples (person_id, distance, pic_id) sorted by distance,
+        only with the matches whose distance is within the tolerance
+        '''
+        if not len(self):
+            return []
+        rows = self._candidates(encoding)
+        distances = self.distances(encoding, rows)
+        k = min(k, len(distances))
+        nearest = np.argpartition(distances, k - 1)[:k]
+        nearest = nearest[np.argsort(distances[nearest])]
+        positions = nearest if rows is None else rows[nearest]
+        return [(int(self.person_ids[row]), float(distances[i]), int(self.pic_ids[row]))
+                for i, row in zip(nearest, positions) if distances[i] <= tolerance]
+
+    def best_match(self, encoding, tolerance=TOLERANCE):
+        '''
+        Returns tuple (matched, person_id, distance) for the closest encoding.
+        person_id is None if the gallery is empty
+        '''
+        return self.best_matches([encoding], tolerance)[0]
+
+    def _exhaustive_match(self, encoding, tolerance):
+        if not len(self):
+            return (False, None, None)
+        rows = self._candidates(encoding)
+        distances = self.distances(encoding, rows)
+        nearest = int(np.argmin(distances))
+        distance = float(distances[nearest])
+        row = nearest if rows is None else rows[nearest]
+        return (distance <= tolerance, int(self.person_ids[row]), distance)
+
+    @_locked
+    def best_matches(self, encodings, tolerance=TOLERANCE):
+        '''
+        Returns a tuple (matched, person_id, distance) per encoding,
+        all of them computed in one matrix product when there is no index
+        '''
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        if self.exemplars and len(self):
+            matches = self._get_prototypes().best_matches(encodings, tolerance)
+            # only ambiguous matches are checked against every picture
+            return [match if abs(match[2] - tolerance) > self.margin
+                    else self._exhaustive_match(encoding, tolerance)
+                    for match, encoding in zip(matches, encodings)]
+        if not len(self) or self.index is not None:
+            return [self._exhaustive_match(encoding, tolerance) for encoding in encodings]
+        squared = (self._norms[:self._size][None, :] - 2 * (encodings @ self.encodings.T)
+                   + np.einsum('ij,ij->i', encodings, encodings)[:, None])
+        nearest = np.argmin(squared, axis=1)
+        distances = np.sqrt(np.maximum(squared[np.arange(len(encodings)), nearest], 0))
+        return [(float(distance) <= tolerance, int(self.person_ids[row]), float(distance))
+                for row, distance in zip(nearest, distances)]
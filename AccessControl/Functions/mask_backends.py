@@ -0,0 +1,174 @@
+import os
+import argparse
+import threading
+import numpy as np
+from PIL import Image
+
+
+INPUT_SIZE = (224, 224)
+
+
+def preprocess(faces, out=None):
+    '''
+    MobileNetV2 preprocessing (same as keras preprocess_input) of RGB uint8
+    faces, without importing TensorFlow. Writes into out when given
+    '''
+    out = np.multiply(faces, 1 / 127.5, out=out, dtype='float32', casting='unsafe')
+    out -= 1.0
+    return out
+
+
+class KerasMaskModel:
+    '''
+    Reference backend, the trained model loaded with TensorFlow
+    '''
+
+    def __init__(self, path):
+        from tensorflow.keras.models import load_model
+        self.model = load_model(os.path.abspath(path))
+
+    def predict_on_batch(self, faces):
+        return np.asarray(self.model.predict_on_batch(faces))
+
+    def predict(self, faces, batch_size=32):
+        return self.model.predict(faces, batch_size=batch_size)
+
+
+class TFLiteMaskModel:
+    '''
+    Light backend, runs a model exported with convert_to_tflite.
+    Uses tflite_runtime when installed, so TensorFlow is never imported,
+    and takes care of the scale of int8 quantized models.
+    The interpreter is not thread safe, calls take turns
+    '''
+
+    def __init__(self, path, threads=None):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+        self.interpreter = Interpreter(model_path=os.path.abspath(path), num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self._batch = None
+        self._lock = threading.Lock()
+
+    def predict_on_batch(self, faces):
+        with self._lock:
+            return self._predict(np.asarray(faces, dtype='float32'))
+
+    def _predict(self, faces):
+        if len(faces) != self._batch:
+            # the interpreter is resized only when the batch size changes
+            self.interpreter.resize_tensor_input(self._input['index'], faces.shape)
+            self.interpreter.allocate_tensors()
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._batch = len(faces)
+
+        scale, zero_point = self._input['quantization']
+        if scale:
+            limits = np.iinfo(self._input['dtype'])
+            faces = np.clip(np.round(faces / scale + zero_point), limits.min, limits.max)
+        self.interpreter.set_tensor(self._input['index'], faces.astype(self._input['dtype']))
+        self.interpreter.invoke()
+        preds = self.interpreter.get_tensor(self._output['index'])
+
+        scale, zero_point = self._output['quantization']
+        if scale:
+            preds = (preds.astype('float32') - zero_point) * scale
+        return preds
+
+    def predict(self, faces, batch_size=32):
+        return self.predict_on_batch(faces)
+
+
+def load_mask_model(path, threads=None):
+    '''
+    Loads the mask classifier with the backend matching the file
+    '''
+    if path.endswith('.tflite'):
+        return TFLiteMaskModel(path, threads)
+    return KerasMaskModel(path)
+
+
+def load_images(directory, limit=None):
+    '''
+    Returns the pictures on the directory, as RGB arrays resized to the
+    model input
+    '''
+    images = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            try:
+                image = Image.open(os.path.join(root, name)).convert('RGB')
+            except OSError:
+                continue
+            images.append(np.array(image.resize(INPUT_SIZE)))
+    return np.array(images[:limit], dtype='uint8')
+
+
+def convert_to_tflite(model_path, output_path, quantize=False, images_dir=None):
+    '''
+    Exports the Keras model to TFLite. With quantize, weights and activations
+    are quantized to int8, calibrated with the pictures on images_dir
+    '''
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(os.path.abspath(model_path))
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantize:
+        calibration = preprocess(load_images(images_dir, limit=200))
+
+        def representative_dataset():
+            for face in calibration:
+                yield [face[None, ...]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.int8
+        converter.inference_output_type = tf.int8
+
+    with open(output_path, 'wb') as file:
+        file.write(converter.convert())
+
+
+def check_parity(model_path, tflite_path, images_dir):
+    '''
+    Runs the Keras and the TFLite models on the same pictures.
+    Returns tuple (max absolute difference, fraction of equal labels)
+    '''
+    faces = preprocess(load_images(images_dir))
+    reference = KerasMaskModel(model_path).predict_on_batch(faces)
+    light = TFLiteMaskModel(tflite_path).predict_on_batch(faces)
+    difference = float(np.abs(reference - light).max())
+    agreement = float(np.mean(reference.argmax(axis=1) == light.argmax(axis=1)))
+    return difference, agreement
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('action', choices=['convert', 'parity'])
+    ap.add_argument("-m", "--model", type=str,
+                    default="../MaskDetection/mask_detector.model",
+                    help="path to trained face mask detector model")
+    ap.add_argument('-o', '--output', type=str,
+                    default="../MaskDetection/mask_detector.tflite",
+                    help="path to the TFLite model")
+    ap.add_argument('-i', '--images', type=str, default="../.IMGs",
+                    help="pictures used for calibration and parity")
+    ap.add_argument('--quantize', action='store_true')
+    args = vars(ap.parse_args())
+
+    if args['action'] == 'convert':
+        convert_to_tflite(args['model'], args['output'], args['quantize'], args['images'])
+        print(f"Model exported to {args['output']}")
+    else:
+        difference, agreement = check_parity(args['model'], args['output'], args['images'])
+        print(f'Max difference: {difference:.4f}, labels agreement: {agreement:.2%}')
+
+
+if __name__ == "__main__":
+    main()
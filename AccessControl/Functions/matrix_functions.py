@@ -1,11 +1,21 @@
 from nio import AsyncClient
+from decouple import config
+
+
+def _client_class():
+    # MATRIX_BACKEND=fake runs against the in-process fake homeserver
+    if config('MATRIX_BACKEND', default='nio') == 'fake':
+        from AccessControl.Functions.fake_matrix import fake_client
+        return fake_client
+    return AsyncClient
 
 
 async def matrix_login(server, user, password, device_id=None):
+    Client = _client_class()
     if device_id:
-        client = AsyncClient(server, user, device_id)
+        client = Client(server, user, device_id)
     else:
-        client = AsyncClient(server, user)
+        client = Client(server, user)
     await client.login(password)
     return client
 
@@ -16,7 +26,7 @@ async def matrix_get_room_id(client, room_name):
 
 
 async def matrix_send_message(client, room_id, message):
-    await client.room_send(
+    return await client.room_send(
         room_id=room_id,
         message_type="m.room.message",
         content={
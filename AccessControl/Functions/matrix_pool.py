@@ -0,0 +1,221 @@
+import os
+import time
+import atexit
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError
+from decouple import config
+import AccessControl.Functions.matrix_functions as mx
+
+
+# seconds a caller keeps waiting past the deadline of its message, for the
+# client thread to report that it dropped it
+DEADLINE_GRACE = 1
+
+
+class MatrixSendError(Exception):
+    '''
+    A message could not be sent: the queue was full, the send timed out or
+    the server answered with an error
+    '''
+
+
+def _token_expired(response):
+    return getattr(response, 'status_code', None) in {'M_UNKNOWN_TOKEN', 'M_MISSING_TOKEN'}
+
+
+class MatrixClientManager:
+    '''
+    Long lived Matrix client for code that is not async (the API workers).
+    The client lives on the event loop of its own thread, logs in once and
+    keeps the room ids it resolved. Messages wait on a bounded queue and are
+    sent one after the other; when the token is no longer valid the client
+    logs in again and the message is retried once. A message not sent by its
+    deadline is cancelled on the client thread, it never reaches the server
+    after its caller was told it failed.
+    It starts on first use, and starts again in a forked worker
+    '''
+
+    def __init__(self, server, user, password, device_id=None, queue_size=32, timeout=10):
+        self.server = server
+        self.user = user
+        self.password = password
+        self.device_id = device_id
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.sent = 0
+        self.failed = 0
+        self.logins = 0
+        self.send_time = 0.0  # total seconds spent sending
+        self._client = None
+        self._rooms = {}  # room name -> room id
+        self._loop = None
+        self._queue = None
+        self._thread = None
+        self._sender_task = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return (f'MatrixClientManager... sent: {self.sent}, failed: {self.failed}, '
+                f'logins: {self.logins}, queued: {self.queued()}')
+
+    def stats(self):
+        return {'sent': self.sent, 'failed': self.failed, 'logins': self.logins,
+                'queued': self.queued(), 'mean_send': self.send_time / self.sent if self.sent else 0}
+
+    def queued(self):
+        return self._queue.qsize() if self._queue else 0
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid() and self._thread.is_alive():
+                return
+            # a forked worker inherits the state but not the thread
+            self._pid = os.getpid()
+            self._client = None
+            self._rooms = {}
+            self._loop = asyncio.new_event_loop()
+            started = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(started,), daemon=True)
+            self._thread.start()
+            if not started.wait(self.timeout):
+                # the next call starts it again
+                self._pid = None
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                raise MatrixSendError('Matrix client thread did not start')
+
+    def _run(self, started):
+        asyncio.set_event_loop(self._loop)
+        self._queue = asyncio.Queue(self.queue_size)
+        self._sender_task = self._loop.create_task(self._sender())
+        self._loop.call_soon(started.set)
+        self._loop.run_forever()
+
+    async def _login(self):
+        if self._client is not None:
+            await self._client.close()
+        self._client = await mx.matrix_login(self.server, self.user, self.password, self.device_id)
+        self._rooms.clear()
+        self.logins += 1
+
+    async def _send(self, room_name, message):
+        if room_name not in self._rooms:
+            response = await self._client.room_resolve_alias(room_name)
+            if not hasattr(response, 'room_id'):
+                return response
+            self._rooms[room_name] = response.room_id
+        return await mx.matrix_send_message(self._client, self._rooms[room_name], message)
+
+    async def _deliver(self, room_name, message):
+        for _ in range(2):
+            if self._client is None:
+                await self._login()
+            response = await self._send(room_name, message)
+            if not _token_expired(response):
+                break
+            await self._login()
+        if not hasattr(response, 'event_id'):
+            raise MatrixSendError(f'Matrix answered {response}')
+        return response
+
+    async def _sender(self):
+        while True:
+            room_name, message, future, deadline = await self._queue.get()
+            # the caller stopped waiting for it
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.time()
+            if start >= deadline:
+                self.failed += 1
+                future.set_exception(MatrixSendError('Matrix send expired in the queue'))
+                continue
+            try:
+                # cancelled at the deadline, whatever step it is on
+                response = await asyncio.wait_for(self._deliver(room_name, message), deadline - start)
+            except Exception as error:
+                self.failed += 1
+                future.set_exception(error)
+            else:
+                self.sent += 1
+                self.send_time += time.time() - start
+                future.set_result(response)
+
+    def _put(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.failed += 1
+            item[2].set_exception(MatrixSendError('Matrix send queue is full'))
+
+    def send(self, room_name, message, timeout=None):
+        '''
+        Sends the message to the room (by alias) and waits for the answer.
+        Raises MatrixSendError if it could not be sent in timeout seconds,
+        the message is then dropped or cancelled
+        '''
+        timeout = timeout or self.timeout
+        self._start()
+        future = Future()
+        self._loop.call_soon_threadsafe(self._put, (room_name, message, future, time.time() + timeout))
+        try:
+            # the client thread enforces the deadline and answers first
+            return future.result(timeout + DEADLINE_GRACE)
+        except TimeoutError:
+            future.cancel()
+            raise MatrixSendError('Matrix send timed out')
+        except asyncio.TimeoutError:
+            raise MatrixSendError('Matrix send timed out')
+
+    async def _shutdown(self):
+        self._sender_task.cancel()
+        await asyncio.gather(self._sender_task, return_exceptions=True)
+        if self._client is not None:
+            # the device of the worker is removed along with its token
+            await mx.matrix_logout_close(self._client)
+
+    def close(self):
+        if self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        closing = asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+        try:
+            closing.result(self.timeout)
+        except Exception as error:
+            print(f'Error closing the Matrix client: {error!r}')
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(self.timeout)
+
+
+_manager = None
+
+
+def worker_device_id():
+    '''
+    Returns the Matrix device id of this API worker, MATRIX_DEVICE_ID_BACKEND
+    followed by the uwsgi worker id (0 out of uwsgi)
+    '''
+    try:
+        import uwsgi
+        worker_id = uwsgi.worker_id()
+    except ImportError:
+        worker_id = 0
+    return f"{config('MATRIX_DEVICE_ID_BACKEND', default='AccessControlAPI')}-{worker_id}"
+
+
+def get_client_manager():
+    '''
+    Returns the client manager of the process.
+    Every worker logs in with a device of its own, so their logins do not
+    invalidate each other, and always the same one, so a worker that was
+    recycled or killed before logging out takes its device back instead of
+    leaving it behind on the server. It is first called from a request,
+    inside the worker (uwsgi runs with lazy-apps)
+    '''
+    global _manager
+    if _manager is None:
+        _manager = MatrixClientManager(config('MATRIX_SERVER'), config('MATRIX_USER'),
+                                       config('MATRIX_PASSWORD'), worker_device_id(),
+                                       queue_size=config('MATRIX_SEND_QUEUE', default=32, cast=int),
+                                       timeout=config('MATRIX_TIMEOUT', default=10, cast=float))
+        atexit.register(_manager.close)
+    return _manager
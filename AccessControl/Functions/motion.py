@@ -0,0 +1,76 @@
+import time
+import numpy as np
+from cv2 import cv2
+
+
+def parse_roi(roi):
+    '''
+    Parses a 'x,y,width,height' string of fractions of the frame.
+    Returns None (whole frame) for an empty string
+    '''
+    if not roi:
+        return None
+    x, y, width, height = (float(value) for value in roi.split(','))
+    return (x, y, width, height)
+
+
+class MotionGate:
+    '''
+    Cheap change detector that gates the expensive stages.
+    Frames are cropped to the region of interest, downscaled to a small
+    grayscale image and compared with a running average background. There is
+    motion when the fraction of changed pixels reaches threshold, and the
+    gate stays open for hold seconds after the last motion.
+    Counters: frames checked and frames skipped for lack of motion
+    '''
+
+    def __init__(self, threshold=0.01, roi=None, width=160, alpha=0.05, pixel_threshold=25, hold=2):
+        self.threshold = threshold
+        self.roi = roi
+        self.width = width
+        self.alpha = alpha  # how fast the background follows the scene
+        self.pixel_threshold = pixel_threshold
+        self.hold = hold
+        self.checked = 0
+        self.skipped = 0
+        self._background = None
+        self._last_motion = 0
+
+    def __str__(self) -> str:
+        return f'MotionGate... checked: {self.checked}, skipped: {self.skipped}'
+
+    def stats(self):
+        return {'checked': self.checked, 'skipped': self.skipped}
+
+    def _prepare(self, frame):
+        if self.roi:
+            (h, w) = frame.shape[:2]
+            x, y, width, height = self.roi
+            frame = frame[int(y * h):int((y + height) * h), int(x * w):int((x + width) * w)]
+        scale = self.width / frame.shape[1]
+        small = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(small, (5, 5), 0)
+
+    def check(self, frame):
+        '''
+        Returns True if the expensive stages should run on the frame
+        '''
+        small = self._prepare(frame)
+        self.checked += 1
+        now = time.time()
+        if self._background is None or self._background.shape != small.shape:
+            self._background = small.astype('float32')
+            self._last_motion = now
+            return True
+
+        diff = cv2.absdiff(small, cv2.convertScaleAbs(self._background))
+        changed = np.count_nonzero(diff > self.pixel_threshold) / diff.size
+        cv2.accumulateWeighted(small, self._background, self.alpha)
+        if changed >= self.threshold:
+            self._last_motion = now
+
+        if now - self._last_motion <= self.hold:
+            return True
+        self.skipped += 1
+        return False
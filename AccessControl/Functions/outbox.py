@@ -0,0 +1,138 @@
+import time
+import asyncio
+from collections import deque
+import numpy as np
+import AccessControl.Functions.matrix_functions as mx
+
+
+DOOR = 0  # commands, sent first
+PROMPT = 1  # speaker prompts
+LATENCY_WINDOW = 200  # send latencies kept per room
+
+
+class _Room:
+    def __init__(self, room_id, priority, window, join):
+        self.room_id = room_id
+        self.priority = priority
+        self.window = window
+        self.join = join
+        self.queue = deque()  # (message, time queued)
+        self.recent = {}  # message -> time it was last queued
+        self.wakeup = asyncio.Event()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy = False
+        self.task = None
+
+    def stats(self):
+        p50, p95 = np.percentile(self.latencies, [50, 95]) if self.latencies else (0, 0)
+        return {'queued': len(self.queue), 'sent': self.sent, 'coalesced': self.coalesced,
+                'dropped': self.dropped, 'failed': self.failed, 'p50': float(p50), 'p95': float(p95)}
+
+
+class Outbox:
+    '''
+    Sends the Matrix messages of a camera in the background, so a slow
+    server never holds the frame loop. Every room has its own queue and
+    sending task.
+    A prompt already queued or sent to a room less than its window seconds
+    ago is dropped (coalesced), and prompts waiting together are sent as one
+    message, a line each. Prompt rooms wait while door commands are pending.
+    Latency is measured from queued to sent
+    '''
+
+    def __init__(self, client, max_size=64):
+        self.client = client
+        self.max_size = max_size
+        self._rooms = {}
+        self._urgent = 0  # door commands queued or being sent
+        self._urgent_done = asyncio.Event()
+        self._urgent_done.set()
+
+    def __str__(self) -> str:
+        rooms = ', '.join(f"{room_id}: {stats['queued']} queued, {stats['sent']} sent, "
+                          f"{stats['coalesced']} coalesced, p95 {stats['p95']*1000:.0f}ms"
+                          for room_id, stats in self.stats().items())
+        return f'Outbox... {rooms}'
+
+    def stats(self):
+        return {room_id: room.stats() for room_id, room in self._rooms.items()}
+
+    def add_room(self, room_id, priority=PROMPT, window=0, join=None):
+        '''
+        Starts the queue of a room. window is the coalescing window in
+        seconds, join sends the queued messages together (prompts by default)
+        '''
+        room = _Room(room_id, priority, window, priority == PROMPT if join is None else join)
+        room.task = asyncio.create_task(self._sender(room))
+        self._rooms[room_id] = room
+        return self
+
+    def send(self, room_id, message):
+        '''
+        Queues the message, returns False if it was coalesced or dropped
+        '''
+        room = self._rooms[room_id]
+        now = time.time()
+        if room.window and now - room.recent.get(message, -room.window) < room.window:
+            room.coalesced += 1
+            return False
+        if len(room.queue) >= self.max_size:
+            room.dropped += 1
+            return False
+        room.recent[message] = now
+        room.queue.append((message, now))
+        if room.priority == DOOR:
+            self._urgent += 1
+            self._urgent_done.clear()
+        room.wakeup.set()
+        return True
+
+    async def _sender(self, room):
+        while True:
+            if not room.queue:
+                room.wakeup.clear()
+                await room.wakeup.wait()
+            if room.priority != DOOR:
+                await self._urgent_done.wait()
+
+            if room.join:
+                batch = list(room.queue)
+                room.queue.clear()
+            else:
+                batch = [room.queue.popleft()]
+            room.busy = True
+            try:
+                response = await mx.matrix_send_message(
+                    self.client, room.room_id, '\n'.join(message for message, _ in batch))
+                if not hasattr(response, 'event_id'):
+                    raise RuntimeError(response)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                room.failed += len(batch)
+                print(f'Error sending {batch} to {room.room_id}: {error!r}')
+            else:
+                now = time.time()
+                room.sent += len(batch)
+                room.latencies.extend(now - queued for _, queued in batch)
+            finally:
+                room.busy = False
+                if room.priority == DOOR:
+                    self._urgent -= len(batch)
+                    if not self._urgent:
+                        self._urgent_done.set()
+
+    async def close(self, timeout=5):
+        '''
+        Waits up to timeout seconds for the queues to empty, then stops
+        '''
+        deadline = time.time() + timeout
+        while any(room.queue or room.busy for room in self._rooms.values()) and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        for room in self._rooms.values():
+            room.task.cancel()
+        await asyncio.gather(*(room.task for room in self._rooms.values()), return_exceptions=True)
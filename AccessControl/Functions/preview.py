@@ -0,0 +1,117 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cv2 import cv2
+
+
+BOUNDARY = 'frame'
+
+
+class PreviewServer:
+    '''
+    Low rate MJPEG debug preview of the cameras, over HTTP.
+    /<camera id> streams a camera, / lists them. Cameras only hand over a
+    reference to their newest frame and face locations; frames are encoded
+    on the connection threads, at most fps per second, and only while a
+    client is watching that camera
+    '''
+
+    def __init__(self, host='127.0.0.1', port=8081, fps=2, quality=70):
+        self.fps = fps
+        self.quality = quality
+        self._frames = {}  # camera id -> (frame, locations)
+        self._viewers = {}  # camera id -> connected clients
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __str__(self) -> str:
+        return f'PreviewServer... {self._server.server_address}, viewers: {self._viewers}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def watched(self, camera_id):
+        return self._viewers.get(camera_id, 0) > 0
+
+    def publish(self, camera_id, frame, locations=()):
+        '''
+        Offers the newest frame of a camera, with the locations of the faces
+        as (startX, startY, endX, endY). Does nothing if no one is watching
+        '''
+        with self._lock:
+            self._frames[camera_id] = (frame, list(locations)) if self.watched(camera_id) else None
+
+    def _encode(self, camera_id):
+        with self._lock:
+            published = self._frames.get(camera_id)
+        if published is None:
+            return None
+        frame, locations = published
+        if locations:
+            frame = frame.copy()
+            for (startX, startY, endX, endY) in locations:
+                cv2.rectangle(frame, (int(startX), int(startY)), (int(endX), int(endY)), (0, 255, 0), 2)
+        ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return jpeg.tobytes() if ok else None
+
+    def _stream(self, request, camera_id):
+        request.send_response(200)
+        request.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+        request.send_header('Cache-Control', 'no-cache')
+        request.end_headers()
+        with self._lock:
+            self._viewers[camera_id] = self._viewers.get(camera_id, 0) + 1
+        try:
+            while True:
+                start = time.time()
+                jpeg = self._encode(camera_id)
+                if jpeg:
+                    request.wfile.write(
+                        f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n'
+                        f'Content-Length: {len(jpeg)}\r\n\r\n'.encode())
+                    request.wfile.write(jpeg + b'\r\n')
+                time.sleep(max(0, 1 / self.fps - (time.time() - start)))
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with self._lock:
+                self._viewers[camera_id] -= 1
+                if not self._viewers[camera_id]:
+                    self._frames.pop(camera_id, None)
+
+    def _index(self, request):
+        with self._lock:
+            cameras = sorted(self._frames, key=str)
+        links = ''.join(f'<li><a href="/{camera_id}">Camera {camera_id}</a></li>'
+                        for camera_id in cameras)
+        body = f'<html><body><h1>Cameras</h1><ul>{links}</ul></body></html>'.encode()
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/html')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def _handler(self):
+        preview = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.strip('/')
+                if not path:
+                    preview._index(self)
+                elif path.isdigit():
+                    preview._stream(self, int(path))
+                else:
+                    self.send_error(404)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
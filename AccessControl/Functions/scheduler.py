@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import contextlib
+from collections import deque
+import numpy as np
+
+
+# seconds between runs of each stage, as (idle, loaded). Stages run at the
+# idle interval while the CPU has room and back off towards the loaded one
+DEFAULT_POLICY = {
+    'detect': (0.1, 0.5),
+    'mask': (1, 5),  # classifying again a face already classified
+    'recognition': (2, 8),  # recognizing again a face not recognized
+    'temperature': (1, 5),
+    'start_again': (13, 13),  # a welcomed face is left alone
+    'mask_window': (30, 30),  # a detected mask is trusted
+}
+TIMING_WINDOW = 200  # durations kept per stage for the percentiles
+
+
+def parse_policy(*policies):
+    '''
+    Merges JSON policies over the defaults, later ones win. Each stage takes
+    a fixed interval in seconds or a list [idle interval, loaded interval],
+    e.g. '{"mask": 2, "recognition": [1, 4]}'
+    '''
+    policy = dict(DEFAULT_POLICY)
+    for text in policies:
+        if not text:
+            continue
+        for stage, value in json.loads(text).items():
+            if stage not in DEFAULT_POLICY:
+                raise ValueError(f'Unknown stage {stage}')
+            policy[stage] = (value, value) if isinstance(value, (int, float)) else tuple(value)
+    return policy
+
+
+class CpuMeter:
+    '''
+    Share of the whole machine's CPU used by this process, sampled at most
+    every period seconds. Every camera of a process reads the same meter
+    '''
+
+    def __init__(self, period=1.0):
+        self.period = period
+        self.load = 0.0
+        self._cpus = os.cpu_count() or 1
+        self._wall = time.monotonic()
+        self._cpu = time.process_time()
+
+    def sample(self):
+        wall = time.monotonic()
+        if wall - self._wall >= self.period:
+            cpu = time.process_time()
+            self.load = (cpu - self._cpu) / ((wall - self._wall) * self._cpus)
+            self._wall, self._cpu = wall, cpu
+        return self.load
+
+
+_meter = CpuMeter()
+
+
+class StageScheduler:
+    '''
+    Decides when each stage of a camera runs and times them.
+    A stage is due once its interval has passed since it last ran for a
+    face. Intervals go from the idle to the loaded value of the policy with
+    the pressure, which grows while the process uses more than budget of the
+    CPU and decays while it uses less.
+    Durations (including the wait for an executor worker) are kept per stage
+    '''
+
+    def __init__(self, policy=None, budget=0.75, step=0.25, meter=None):
+        self.policy = policy or dict(DEFAULT_POLICY)
+        self.budget = budget
+        self.step = step
+        self.pressure = 0.0  # 0 runs at the idle intervals, 1 at the loaded ones
+        self.meter = meter or _meter
+        self._timings = {}  # stage -> recent durations
+        self._counts = {}
+        self._last_update = 0
+
+    def __str__(self) -> str:
+        timings = ', '.join(f"{stage}: {stats['p50']*1000:.0f}/{stats['p95']*1000:.0f}ms"
+                            for stage, stats in self.stats().items())
+        return (f'StageScheduler... load: {self.meter.load:.2f}, pressure: {self.pressure:.2f}, '
+                f'p50/p95 {timings}')
+
+    def update(self):
+        '''
+        Backs off when the CPU is over budget, comes back when it is under
+        '''
+        load = self.meter.sample()
+        now = time.monotonic()
+        if now - self._last_update < self.meter.period:
+            return
+        self._last_update = now
+        if load > self.budget:
+            self.pressure = min(1.0, self.pressure + self.step)
+        else:
+            self.pressure = max(0.0, self.pressure - self.step / 2)
+
+    def interval(self, stage):
+        idle, loaded = self.policy[stage]
+        return idle + (loaded - idle) * self.pressure
+
+    def due(self, stage, since):
+        return (time.time() - since) > self.interval(stage)
+
+    def record(self, stage, seconds):
+        self._timings.setdefault(stage, deque(maxlen=TIMING_WINDOW)).append(seconds)
+        self._counts[stage] = self._counts.get(stage, 0) + 1
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    async def run(self, stage, awaitable):
+        with self.timed(stage):
+            return await awaitable
+
+    def stats(self):
+        '''
+        Returns dict stage -> {count, mean, p50, p95, interval} in seconds
+        '''
+        stats = {}
+        for stage, durations in self._timings.items():
+            p50, p95 = np.percentile(durations, [50, 95])
+            stats[stage] = {'count': self._counts[stage], 'mean': float(np.mean(durations)),
+                            'p50': float(p50), 'p95': float(p95),
+                            'interval': self.interval(stage) if stage in self.policy else None}
+        return stats
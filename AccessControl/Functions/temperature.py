@@ -0,0 +1,57 @@
+import asyncio
+
+
+SYNC_TIMEOUT = 30  # seconds a sync waits on the server for new events
+RETRY_DELAY = 2  # seconds to wait after a failed sync
+
+
+class TemperatureFeed:
+    '''
+    Follows the temperature room with a sync long poll on its own task, so
+    readings arrive as soon as the sensor publishes them. latest holds the
+    last message of the room as (body, timestamp in seconds), reading it
+    takes no network call
+    '''
+
+    def __init__(self, client, room_id, timeout=SYNC_TIMEOUT):
+        self.client = client
+        self.room_id = room_id
+        self.timeout = timeout
+        self.latest = None
+        self.readings = 0
+        self.errors = 0
+        self._task = None
+
+    def __str__(self) -> str:
+        return f'TemperatureFeed... latest: {self.latest}, readings: {self.readings}, errors: {self.errors}'
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        # only the temperature room, the first sync brings its last message
+        sync_filter = {'room': {'rooms': [self.room_id], 'timeline': {'limit': 1},
+                                'state': {'lazy_load_members': True}}}
+        while True:
+            try:
+                response = await self.client.sync(timeout=int(self.timeout * 1000), sync_filter=sync_filter)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                response = error
+            if not hasattr(response, 'rooms'):
+                self.errors += 1
+                print(f'Temperature sync failed: {response!r}')
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+
+            room = response.rooms.join.get(self.room_id)
+            for event in room.timeline.events if room else []:
+                if hasattr(event, 'body'):
+                    self.latest = (event.body, event.server_timestamp / 1000)
+                    self.readings += 1
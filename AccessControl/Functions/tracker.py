@@ -0,0 +1,98 @@
+import time
+import numpy as np
+from AccessControl.Functions.face_state import FaceState
+
+
+class Track(FaceState):
+    '''
+    A face followed across frames, it carries its own decision state
+    '''
+
+    def __init__(self, track_id, location):
+        super().__init__(location)
+        self.id = track_id
+        self.hits = 1
+
+    def __str__(self) -> str:
+        return f'Track {self.id}... {super().__str__()}'
+
+    def see(self, location):
+        super().see(location)
+        self.hits += 1
+
+
+def iou(box_a, box_b):
+    '''
+    Intersection over union of two (startX, startY, endX, endY) boxes
+    '''
+    startX, startY = max(box_a[0], box_b[0]), max(box_a[1], box_b[1])
+    endX, endY = min(box_a[2], box_b[2]), min(box_a[3], box_b[3])
+    intersection = max(0, endX - startX) * max(0, endY - startY)
+    area_a = (box_a[2] - box_a[0]) * (box_a[3] - box_a[1])
+    area_b = (box_b[2] - box_b[0]) * (box_b[3] - box_b[1])
+    union = area_a + area_b - intersection
+    return intersection / union if union > 0 else 0
+
+
+def _center(box):
+    return np.array(((box[0] + box[2]) / 2, (box[1] + box[3]) / 2))
+
+
+class Tracker:
+    '''
+    Assigns the faces found on each detection to tracks.
+    Detections are paired with the track whose box overlaps them the most,
+    or, for faces that moved fast, whose center is less than a face width
+    away. Tracks missed by max_misses detections in a row (and not seen for
+    at least max_age seconds) are dropped, so a new person taking the place
+    of someone who left never inherits their state
+    '''
+
+    def __init__(self, min_iou=0.3, max_age=2, max_misses=3):
+        self.min_iou = min_iou
+        self.max_age = max_age
+        self.max_misses = max_misses
+        self.tracks = []
+        self._next_id = 1
+
+    def _score(self, track, location):
+        overlap = iou(track.location, location)
+        if overlap >= self.min_iou:
+            return 1 + overlap
+        startX, startY, endX, endY = track.location
+        width = max(endX - startX, endY - startY)
+        distance = np.linalg.norm(_center(track.location) - _center(location))
+        # centroid matches always rank below overlap matches
+        return 1 - distance / width if distance < width else 0
+
+    def update(self, locations, interval=0):
+        '''
+        Returns the track of every location, in the same order.
+        interval is the current time between detections
+        '''
+        now = time.time()
+        max_age = max(self.max_age, self.max_misses * interval)
+        self.tracks = [track for track in self.tracks if now - track.last_seen <= max_age]
+
+        pairs = []
+        for i, track in enumerate(self.tracks):
+            for j, location in enumerate(locations):
+                score = self._score(track, location)
+                if score > 0:
+                    pairs.append((score, i, j))
+
+        matched = [None] * len(locations)
+        used = set()
+        for _, i, j in sorted(pairs, reverse=True):
+            if i not in used and matched[j] is None:
+                matched[j] = self.tracks[i]
+                used.add(i)
+
+        for j, location in enumerate(locations):
+            if matched[j] is None:
+                matched[j] = Track(self._next_id, location)
+                self._next_id += 1
+                self.tracks.append(matched[j])
+            else:
+                matched[j].see(location)
+        return matched
@@ -1,3 +1,6 @@
+import time
+_start = time.perf_counter()
+
 import os
 import argparse
 import asyncio
@@ -25,11 +28,28 @@ def main():
 
     args = vars(ap.parse_args())
 
+    phases = [('imports', time.perf_counter() - _start)]
+    start = time.perf_counter()
     maskNet, faceNet = func.get_mask_face_net(config('FACE'), config('MODEL'))
+    phases.append(('models', time.perf_counter() - start))
 
     camera = crud.get_entry(classes.Camera, args['camera'])
 
-    asyncio.run(func.face_recog_live(faceNet, maskNet,camera))
+    # the first frames would otherwise pay for the models initialization
+    start = time.perf_counter()
+    func.warm_up(faceNet, maskNet, scale=camera.detection_scale)
+    phases.append(('warm-up', time.perf_counter() - start))
+    func.print_startup(phases)
+
+    # without a display there are no windows, the recognizer is stopped with
+    # SIGINT or SIGTERM. A debug preview can be served with PREVIEW_PORT
+    preview = func.get_preview()
+    try:
+        asyncio.run(func.run_until_signal(func.face_recog_live(
+            faceNet, maskNet, camera, headless=args['headless'], preview=preview)))
+    finally:
+        if preview:
+            preview.stop()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,292 @@
+import os
+import time
+import datetime
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import Counter
+import numpy as np
+from cv2 import cv2
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+# --fast runs the detector on every frame, so the fps measure the pipeline
+# and not the pace of the detect interval
+FAST_POLICY = '{"detect": 0}'
+
+
+class ReplaySource:
+    '''
+    Stand-in for the FrameGrabber that plays video files and picture
+    directories, one after the other. Each picture stays on screen for
+    image_seconds, at fps frames per second.
+    In realtime it behaves as a camera: a read gets the frame due at that
+    moment and the frames the pipeline was too slow for are dropped.
+    Otherwise every frame is handed out, as fast as they are read.
+    segments holds (name, second on the timeline) of every file played
+    '''
+
+    def __init__(self, paths, fps=10, image_seconds=3, realtime=True):
+        self.fps = fps
+        self.image_seconds = image_seconds
+        self.realtime = realtime
+        self.segments = []
+        self.captured = 0
+        self.dropped = 0
+        self.lag = 0.0
+        self.finished = threading.Event()
+        self.started = None
+        self._frames = self._timeline(paths)
+        self._pending = None
+
+    def __str__(self) -> str:
+        return f'ReplaySource... read: {self.captured}, dropped: {self.dropped}, lag: {self.lag:.3f}s'
+
+    def stats(self):
+        return {'captured': self.captured, 'dropped': self.dropped, 'lag': self.lag}
+
+    def start(self):
+        self.started = time.time()
+        return self
+
+    def stop(self):
+        self.finished.set()
+
+    def _timeline(self, paths):
+        position = 0.0
+        for path in paths:
+            if os.path.isdir(path):
+                for name in sorted(os.listdir(path)):
+                    if not name.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    frame = cv2.imread(os.path.join(path, name))
+                    if frame is None:
+                        continue
+                    self.segments.append((name, position))
+                    for _ in range(max(1, round(self.image_seconds * self.fps))):
+                        yield position, frame
+                        position += 1 / self.fps
+            else:
+                capture = cv2.VideoCapture(path)
+                fps = capture.get(cv2.CAP_PROP_FPS) or self.fps
+                self.segments.append((os.path.basename(path), position))
+                while True:
+                    ok, frame = capture.read()
+                    if not ok:
+                        break
+                    yield position, frame
+                    position += 1 / fps
+                capture.release()
+
+    def _next(self):
+        if self._pending is None:
+            self._pending = next(self._frames, None)
+            if self._pending is None:
+                self.finished.set()
+        return self._pending
+
+    def read(self, timeout=1.0):
+        '''
+        Returns (ok, frame) like FrameGrabber.read, the frame is a copy
+        '''
+        if self._next() is None:
+            return False, None
+        if self.realtime:
+            position, frame = self._pending
+            wait = position - (time.time() - self.started)
+            if wait > timeout:
+                time.sleep(timeout)
+                return False, None
+            time.sleep(max(0, wait))
+            # frames whose time has passed are skipped, as a live camera would
+            self._pending = None
+            while self._next() is not None and self._pending[0] <= time.time() - self.started:
+                position, frame = self._pending
+                self._pending = None
+                self.dropped += 1
+            self.lag = time.time() - self.started - position
+        else:
+            _, frame = self._pending
+            self._pending = None
+        self.captured += 1
+        return True, frame.copy()
+
+
+def set_environment(workdir):
+    '''
+    Points the data modules to a sqlite database and an encoding cache on
+    workdir, and Matrix to the in-process fake homeserver. Must run before
+    they are imported, the replay never touches the real database or server
+    '''
+    os.environ['DB_URL'] = f"sqlite:///{os.path.join(workdir, 'replay.db')}"
+    os.environ['ENCODING_CACHE_DIR'] = os.path.join(workdir, 'cache')
+    os.environ['MATRIX_BACKEND'] = 'fake'
+    for name in ('MATRIX_SERVER', 'MATRIX_USER', 'MATRIX_PASSWORD', 'MATRIX_DEVICE_ID_FACERECOG'):
+        os.environ.setdefault(name, 'replay')
+    os.environ.setdefault('MATRIX_ROOM_NAME_TEMPERATURE', '#temperature')
+    os.environ.setdefault('MATRIX_ROOM_NAME_SPEAKER', '#speaker')
+    os.environ.setdefault('MATRIX_ROOM_NAME_DOOR', '#door')
+
+
+def seed(known_dir, ask_mask=False, ask_temp=False):
+    '''
+    Creates the tables, the configuration and one camera, and adds a person
+    for each known picture. Pictures named <person>_<n> belong to the same
+    person. Returns the camera
+    '''
+    import AccessControl.Data.classes as classes
+    import AccessControl.Data.crud as crud
+    import AccessControl.Data.enums as enums
+    import AccessControl.Data.data_manipulation as dm
+
+    classes.Base.metadata.drop_all(classes.engine)
+    classes.Base.metadata.create_all(classes.engine)
+    crud.add_entry(classes.Configuration(
+        start_time=datetime.time(0, 0, 0), end_time=datetime.time(23, 59, 59),
+        profile=enums.PictureClassification.ALL_ACTIVE, country=enums.CountryCodes.DOM))
+    camera = classes.Camera(ip_address='0.0.0.0', user='replay', password='replay', route='/',
+                            entry_type=enums.EntryTypes.ENTRY, ask_mask=ask_mask, ask_temp=ask_temp)
+    crud.add_entry(camera)
+
+    persons = {}
+    for name in sorted(os.listdir(known_dir)):
+        if not name.lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        with open(os.path.join(known_dir, name), 'rb') as file:
+            data = dm.process_picture_file(file)
+        if not data:
+            print(f'No face found on {name}')
+            continue
+        key = os.path.splitext(name)[0].rsplit('_', 1)[0]
+        if key not in persons:
+            persons[key] = classes.Person(identification_document=key[:20], first_name=key[:30],
+                                          last_name='', cellphone='', role=enums.PersonRole.EMPLOYEE)
+        raw_bin_pic, face_encoding = data
+        crud.add_entry(classes.Picture(picture_bytes=raw_bin_pic, face_bytes=face_encoding,
+                                       person=persons[key]))
+    print(f'Seeded {len(persons)} persons')
+    return camera
+
+
+async def publish_temperature(temperature, interval):
+    '''
+    Plays the sensor, a reading on the temperature room every interval seconds
+    '''
+    from AccessControl.Functions.fake_matrix import homeserver
+
+    room_id = homeserver.resolve(os.environ['MATRIX_ROOM_NAME_TEMPERATURE'])
+    while True:
+        homeserver.publish(room_id, str(temperature), '@sensor:fake')
+        await asyncio.sleep(interval)
+
+
+async def replay(faceNet, maskNet, camera, source, scheduler, temperature=None, interval=5):
+    '''
+    Runs the live pipeline on the source until it is played to the end
+    '''
+    import AccessControl.Functions.functions as func
+
+    sensor = asyncio.create_task(publish_temperature(temperature, interval)) if temperature else None
+    task = asyncio.create_task(func.face_recog_live(
+        faceNet, maskNet, camera, headless=True, grabber=source, scheduler=scheduler))
+    while not (source.finished.is_set() or task.done()):
+        await asyncio.sleep(0.1)
+    task.cancel()
+    if sensor:
+        sensor.cancel()
+    result, = await asyncio.gather(task, return_exceptions=True)
+    if isinstance(result, Exception):
+        raise result
+
+
+def room_events(alias):
+    from AccessControl.Functions.fake_matrix import homeserver
+
+    return homeserver.events(homeserver.resolve(alias))
+
+
+def decision_latencies(source):
+    '''
+    Returns (segment name, seconds from its first frame to the door opening
+    or None) for every segment of a realtime replay
+    '''
+    doors = [event.server_timestamp / 1000 - source.started
+             for event in room_events(os.environ['MATRIX_ROOM_NAME_DOOR']) if event.body == '1']
+    latencies = []
+    for i, (name, start) in enumerate(source.segments):
+        end = source.segments[i + 1][1] if i + 1 < len(source.segments) else np.inf
+        opened = [door for door in doors if start <= door < end]
+        latencies.append((name, opened[0] - start if opened else None))
+    return latencies
+
+
+def report(source, scheduler, elapsed):
+    print(f'\nFrames... read: {source.captured}, dropped: {source.dropped}, '
+          f'{source.captured / elapsed:.2f} fps over {elapsed:.1f}s')
+
+    print('Policy (s)... ' + ', '.join(f'{stage}: {idle}/{loaded}'
+                                       for stage, (idle, loaded) in scheduler.policy.items()))
+    print('Stage latency (ms)... count, mean, p50, p95')
+    for stage, stats in scheduler.stats().items():
+        print(f"  {stage:12} {stats['count']:6} {stats['mean']*1000:9.1f} "
+              f"{stats['p50']*1000:9.1f} {stats['p95']*1000:9.1f}")
+
+    messages = Counter(message for event in room_events(os.environ['MATRIX_ROOM_NAME_SPEAKER'])
+                       for message in event.body.split('\n'))
+    print(f'Messages... {dict(messages)}')
+
+    if source.realtime:
+        print('Decision latency, first appearance to door open (s)...')
+        for name, latency in decision_latencies(source):
+            print(f"  {name:30} {'-' if latency is None else f'{latency:.2f}'}")
+
+
+def main():
+    ap = argparse.ArgumentParser(
+        description='Replays videos or picture directories through the live pipeline')
+    ap.add_argument('sources', nargs='*', default=['../.IMGs/KnownIMGs', '../.IMGs/UnknownIMGs'],
+                    help='video files or picture directories, played in order')
+    ap.add_argument('-k', '--known', type=str, default='../.IMGs/KnownIMGs',
+                    help='pictures of the persons allowed in, <person>_<n>.jpg')
+    ap.add_argument("-f", "--face", type=str, default="../MaskDetection/face_detector",
+                    help="path to face detector model directory")
+    ap.add_argument("-m", "--model", type=str, default="../MaskDetection/mask_detector.model",
+                    help="path to trained face mask detector model")
+    ap.add_argument('--fps', type=float, default=10)
+    ap.add_argument('--image-seconds', type=float, default=3,
+                    help='seconds each picture stays in front of the camera')
+    ap.add_argument('--fast', action='store_true',
+                    help='hand out every frame as fast as it is read and detect on all of them, for throughput')
+    ap.add_argument('--temperature', type=float, default=36.5,
+                    help='reading the fake sensor publishes, 0 for none')
+    ap.add_argument('--temperature-interval', type=float, default=5)
+    ap.add_argument('--ask-mask', action='store_true')
+    ap.add_argument('--ask-temp', action='store_true')
+    ap.add_argument('--workdir', type=str, default=None,
+                    help='where the sqlite database and encoding cache go')
+    args = vars(ap.parse_args())
+
+    set_environment(args['workdir'] or tempfile.mkdtemp(prefix='replay-'))
+    import AccessControl.Functions.functions as func
+    from AccessControl.Functions.scheduler import StageScheduler, parse_policy
+    from decouple import config
+
+    camera = seed(args['known'], args['ask_mask'], args['ask_temp'])
+    maskNet, faceNet = func.get_mask_face_net(args['face'], args['model'])
+    # model initialization stays out of the measures
+    func.warm_up(faceNet, maskNet, scale=camera.detection_scale)
+    source = ReplaySource(args['sources'], args['fps'], args['image_seconds'], not args['fast'])
+    policies = [config('STAGE_POLICY', default='')]
+    if args['fast']:
+        policies.append(FAST_POLICY)
+    scheduler = StageScheduler(parse_policy(*policies), config('CPU_BUDGET', default=0.75, cast=float))
+
+    start = time.time()
+    asyncio.run(replay(faceNet, maskNet, camera, source, scheduler,
+                       args['temperature'], args['temperature_interval']))
+    report(source, scheduler, time.time() - start)
+
+
+if __name__ == "__main__":
+    main()
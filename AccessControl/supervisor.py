@@ -0,0 +1,134 @@
+import time
+_start = time.perf_counter()
+
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import AccessControl.Functions.functions as func
+import AccessControl.Data.crud as crud
+import AccessControl.Data.classes as classes
+from AccessControl.Functions.batching import MaskBatcher
+
+from decouple import config
+
+
+SUPERVISOR_TICK = 5
+CAMERA_INTERVAL = 30
+PROFILE_INTERVAL = 60
+
+
+def camera_settings(camera):
+    # a running camera is restarted when any of these change
+    return (camera.connection_string(), camera.entry_type, camera.ask_mask,
+            camera.ask_temp, camera.detection_scale, camera.motion_threshold, camera.motion_roi,
+            camera.stage_policy)
+
+
+def load_cameras():
+    # runs on the refresh thread, closing its session detaches the cameras
+    # (every column is loaded) so the camera tasks read them safely
+    try:
+        return {camera.id: camera for camera in crud.get_entries(classes.Camera)}
+    finally:
+        crud.remove_session()
+
+
+def refresh_galleries(galleries):
+    try:
+        func.refresh_galleries(galleries)
+    finally:
+        crud.remove_session()
+
+
+async def stop_camera(camera_id, task):
+    task.cancel()
+    result, = await asyncio.gather(task, return_exceptions=True)
+    if isinstance(result, Exception):
+        print(f'Camera {camera_id} stopped with error: {result!r}')
+
+
+async def supervise(faceNet, maskNet, headless=False, preview=None, phases=()):
+    '''
+    Runs every camera on the cameras table in this process. All of them
+    share the loaded models, the inference executor and the galleries.
+    The table is read again every CAMERA_INTERVAL, new cameras are started,
+    removed or changed ones are stopped (and changed ones started again).
+    The table and the galleries are read on a thread of their own, with its
+    own database session, so the cameras never wait on them.
+    headless and preview are passed to every camera
+    '''
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(config('INFERENCE_WORKERS', default=4, cast=int))
+    refresh_executor = ThreadPoolExecutor(1, thread_name_prefix='refresh')
+    # faces from every camera go through the mask classifier in batches
+    batch_window = config('MASK_BATCH_WINDOW', default=0.005, cast=float)
+    if batch_window > 0:
+        maskNet = MaskBatcher(maskNet, batch_window,
+                              config('MASK_BATCH_SIZE', default=32, cast=int))
+    start = time.perf_counter()
+    galleries = func.get_galleries()
+    phases = list(phases) + [('galleries', time.perf_counter() - start)]
+    # the first frames would otherwise pay for the models initialization
+    start = time.perf_counter()
+    func.warm_up(faceNet, maskNet, galleries.values())
+    phases.append(('warm-up', time.perf_counter() - start))
+    func.print_startup(phases)
+    tasks = {}  # camera id -> (settings, task)
+
+    time_cameras = 0
+    time_profile = time.time()
+    try:
+        while True:
+            if func.has_time_passed(time_cameras, CAMERA_INTERVAL):
+                cameras = await loop.run_in_executor(refresh_executor, load_cameras)
+
+                for camera_id, (settings, task) in list(tasks.items()):
+                    camera = cameras.get(camera_id)
+                    if task.done() or camera is None or camera_settings(camera) != settings:
+                        await stop_camera(camera_id, task)
+                        del tasks[camera_id]
+
+                for camera_id, camera in cameras.items():
+                    if camera_id not in tasks:
+                        print(f'Starting camera {camera_id}')
+                        task = asyncio.create_task(func.face_recog_live(
+                            faceNet, maskNet, camera, executor, galleries, headless, preview))
+                        tasks[camera_id] = (camera_settings(camera), task)
+                time_cameras = time.time()
+                if isinstance(maskNet, MaskBatcher):
+                    print(maskNet)
+
+            if func.has_time_passed(time_profile, PROFILE_INTERVAL):
+                await loop.run_in_executor(refresh_executor, refresh_galleries, galleries)
+                time_profile = time.time()
+
+            await asyncio.sleep(SUPERVISOR_TICK)
+    finally:
+        for camera_id, (_, task) in tasks.items():
+            await stop_camera(camera_id, task)
+        executor.shutdown()
+        refresh_executor.shutdown()
+        if isinstance(maskNet, MaskBatcher):
+            maskNet.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--headless', action='store_true')
+    args = vars(ap.parse_args())
+
+    phases = [('imports', time.perf_counter() - _start)]
+    start = time.perf_counter()
+    maskNet, faceNet = func.get_mask_face_net(config('FACE'), config('MODEL'))
+    phases.append(('models', time.perf_counter() - start))
+
+    preview = func.get_preview()
+    try:
+        asyncio.run(func.run_until_signal(supervise(faceNet, maskNet, args['headless'], preview, phases)))
+    finally:
+        if preview:
+            preview.stop()
+
+
+if __name__ == "__main__":
+    main()